@@ -1,32 +1,234 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+import re
+import sys
 import time
 import random
 import math
+import os
 import json
 import base64
+import io
+import inspect
+import types
 import shutil
+import threading
+import queue
+import sqlite3
+import atexit
+from collections import Counter, deque
 from datetime import datetime, timedelta
 from pathlib import Path
-from playwright.sync_api import sync_playwright
+from urllib.parse import urlparse
+from functools import lru_cache
+from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
+from concurrent.futures import Future, ThreadPoolExecutor
+import httpx
 from openai import OpenAI
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Playwright calls inspect.stack() on every API call to attach the caller's location to
+# errors and traces. That walks every frame and reads source context, which shows up as a
+# large share of CPU time on call-heavy paths (popup scans, fold screenshots). Stack capture
+# is off unless PW_INSPECT_STACK=1; errors keep their messages, only the call site is lost.
+PW_INSPECT_STACK = os.environ.get("PW_INSPECT_STACK", "0") == "1"
+
+class _NoStackInspect(types.ModuleType):
+    """Stand-in for the inspect module inside Playwright whose stack() is empty."""
+    def __getattr__(self, name):
+        return getattr(inspect, name)
+    
+    @staticmethod
+    def stack(context=1):
+        return []
+
+if not PW_INSPECT_STACK:
+    try:
+        from playwright._impl import _connection as _pw_connection, _sync_base as _pw_sync_base
+        _pw_connection.inspect = _pw_sync_base.inspect = _NoStackInspect("inspect")
+    except Exception as e:
+        print(f"⚠️  Could not disable Playwright stack capture: {e}")
+
 app = Flask(__name__)
 
+# Bookings with a tracking run in flight; guarded because gunicorn serves /track from several threads
 requested_bookings = set()
+requested_bookings_lock = threading.Lock()
+
+# Every run drives the same CDP browser (and reuses its first tab), so runs for different
+# bookings take turns instead of closing or navigating each other's pages
+browser_run_lock = threading.Lock()
+
+# LLM calls are plain HTTPS requests, so they can run on worker threads while the
+# main thread keeps driving Playwright (the sync API must stay on its own thread)
+llm_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="llm")
+
+def resolved_future(value):
+    """A Future that is already done, for callers that hand back either a decision or pending work."""
+    future = Future()
+    future.set_result(value)
+    return future
+
+# Screenshot files are written (and fold crops encoded) here, so the main thread can go
+# on to the next capture while the previous one is still being saved
+screenshot_write_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="screenshot-writer")
+_pending_screenshot_writes = {}  # str(path) -> Future, until the file is on disk
+
+def write_screenshot_async(path, image_bytes):
+    """Queue a screenshot file write; readers call wait_for_screenshot(path) before opening it."""
+    key = str(path)
+    future = screenshot_write_pool.submit(Path(path).write_bytes, image_bytes)
+    _pending_screenshot_writes[key] = future
+    
+    def forget(done):
+        # A newer write to the same path may have replaced this entry; leave that one alone
+        if _pending_screenshot_writes.get(key) is done:
+            _pending_screenshot_writes.pop(key, None)
+    
+    future.add_done_callback(forget)
+    return future
+
+def wait_for_screenshot(path):
+    """Block until a queued write of this screenshot (if any) has finished; re-raises its error."""
+    future = _pending_screenshot_writes.get(str(path))
+    if future is not None:
+        future.result()
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+# Per-request OpenAI timeout: the SDK's own default (10 minutes, 5s to connect). Vision
+# calls on gpt-4o with several screenshots can take minutes, so this stays generous.
+OPENAI_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+
+def get_openai_client():
+    """
+    One OpenAI client for the whole process, so runs and pool threads share a single
+    keep-alive connection pool instead of paying a TLS handshake per new client.
+    Created lazily because OpenAI() needs OPENAI_API_KEY at construction time.
+    """
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            limits = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+            try:
+                http_client = httpx.Client(http2=True, limits=limits)
+            except ImportError:
+                # http2 needs the h2 package; plain keep-alive still avoids repeated handshakes
+                http_client = httpx.Client(limits=limits)
+            # The SDK adopts a non-default http_client timeout for every call, so the
+            # client only carries the pool limits and the timeout is set here
+            _openai_client = OpenAI(http_client=http_client, timeout=OPENAI_TIMEOUT)
+        return _openai_client
+
+def warm_openai_connection(client):
+    """Open the API connection ahead of the first agent call (runs on the LLM pool)"""
+    try:
+        client.with_options(max_retries=0, timeout=5).models.list()
+    except Exception as e:
+        print(f"⚠️  OpenAI connection warm-up failed: {e}")
 
 # ============================================================================
 # CACHE MANAGEMENT
 # ============================================================================
 
+# Booking cache files are zstd-compressed when zstandard is installed (scripts and
+# operation lists compress several-fold); plain .json files are still read
+CACHE_FILE_SUFFIX = ".json.zst" if zstandard is not None else ".json"
+_zstd_compressor = zstandard.ZstdCompressor(level=3) if zstandard is not None else None
+_zstd_decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+
+def read_json_file(path):
+    """Decode a JSON cache file (orjson when installed), decompressing .zst files."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    if str(path).endswith(".zst"):
+        raw = _zstd_decompressor.decompress(raw)
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+# Cache files are machine-read; set CACHE_PRETTY_JSON=1 to indent them for inspection
+CACHE_PRETTY_JSON = os.environ.get("CACHE_PRETTY_JSON", "0") == "1"
+
+def write_json_file(path, data):
+    """Serialize in one buffer and swap it in with os.replace, so readers never see a torn file."""
+    if orjson is not None:
+        payload = orjson.dumps(data, option=orjson.OPT_INDENT_2 if CACHE_PRETTY_JSON else 0)
+    else:
+        payload = json.dumps(data, indent=2 if CACHE_PRETTY_JSON else None, separators=None if CACHE_PRETTY_JSON else (",", ":")).encode("utf-8")
+    if str(path).endswith(".zst"):
+        payload = _zstd_compressor.compress(payload)
+    tmp_path = Path(f"{path}.{os.getpid()}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+def with_epoch(record):
+    """
+    Make sure a cache record carries cached_at_epoch next to its ISO cached_at, so TTL
+    checks are one float subtraction. Files written before the field existed get it
+    derived once, when they are loaded.
+    """
+    if "cached_at_epoch" not in record:
+        record["cached_at_epoch"] = datetime.fromisoformat(record.get("cached_at", "2000-01-01")).timestamp()
+    return record
+
+@lru_cache(maxsize=512)
+def cache_file_path(cache_dir, carrier, booking_id):
+    """Path of the cache file for carrier:booking_id, built once per key."""
+    return Path(cache_dir) / f"{carrier}_{booking_id}{CACHE_FILE_SUFFIX}"
+
+def legacy_cache_file_path(path):
+    """Uncompressed .json counterpart of a .json.zst cache file, or None for plain files."""
+    path = str(path)
+    return Path(path[:-len(".zst")]) if path.endswith(".zst") else None
+
+def parse_cache_file_name(name):
+    """(carrier, booking_id) for a booking cache file name, or None for anything else in cache/."""
+    for suffix in (".json.zst", ".json"):
+        if name.endswith(suffix):
+            carrier, sep, booking_id = name[:-len(suffix)].partition("_")
+            return (carrier, booking_id) if sep else None
+    return None
+
+def booking_cache_files(cache_dir):
+    """(path, carrier, booking_id) for every booking cache file; a .json.zst file shadows its legacy .json."""
+    seen = set()
+    for pattern in ("*_*.json.zst", "*_*.json"):
+        for cache_path in Path(cache_dir).glob(pattern):
+            parsed = parse_cache_file_name(cache_path.name)
+            if parsed and parsed not in seen:
+                seen.add(parsed)
+                yield (cache_path, *parsed)
+
+
 class MilestoneCache:
     """
     Caches successful milestone scripts and final results.
     
+    Each carrier:booking_id is stored as a JSON file (the durable record, zstd-compressed as
+    .json.zst when zstandard is installed); cache/milestones.db
+    mirrors the milestones and final results in SQLite so lookups and TTL expiry are queries.
+    
     Cache structure:
     {
         "carrier:booking_id": {
             "cached_at": "timestamp",
+            "cached_at_epoch": 1700000000.0,  # Same instant as cached_at, used for TTL checks
             "final_results": {
+                "cached_at": "timestamp",
                 "voyage_number": "...",
                 "arrival_date": "...",
                 "verification_scripts": [...]  # Scripts to re-verify arrival date
@@ -35,7 +237,8 @@ class MilestoneCache:
                 "Reached hub site": {
                     "cached_at": "timestamp",
                     "script": "exact script that worked",
-                    "operations": ["script_execution_start", "script_execution_result", ...]
+                    "operations": ["script_execution_start", "script_execution_result", ...],
+                    "dom_signature": ["BODY>DIV#header", ...]  # Page structure before the script ran
                 },
                 ...
             }
@@ -47,31 +250,307 @@ class MilestoneCache:
         self.cache_dir = Path(cache_dir)
         self.cache_dir.mkdir(parents=True, exist_ok=True)
         self.cache_ttl_days = 14
+        # Per-milestone index over the JSON files so lookups across bookings are one
+        # indexed query instead of a directory scan; the JSON files stay the source of truth
+        self.index_path = self.cache_dir / "milestones.db"
+        self._local = threading.local()
+        # Decoded cache files by (carrier, booking_id), kept in step with every write so
+        # read-after-write and repeated reads don't go back to disk
+        self._mem = {}
+        self._mem_lock = threading.RLock()
+        # Cache files are advisory, so they are written off the request path: saves update
+        # memory and queue the latest content per file; a daemon thread writes the queue out
+        # at most every WRITE_COALESCE_SECONDS, and atexit flushes whatever is left
+        self._pending_writes = {}
+        self._file_lock = threading.Lock()  # Held while files are written or deleted
+        self._write_wakeup = threading.Event()
+        self._writer_thread = None
+        atexit.register(self.flush)
+        # Carrier-level playbook: the last script that completed each milestone on each carrier,
+        # independent of booking. Loaded once here and used when no per-booking script matches.
+        self.playbook_path = self.cache_dir / "playbooks.json"
+        self._playbook_lock = threading.Lock()
+        self.playbooks = self._load_playbooks()
+        # Expired files are never read again, so sweep them out at startup and then hourly
+        threading.Thread(target=self._vacuum_loop, name="cache-vacuum", daemon=True).start()
+    
+    def _load_playbooks(self):
+        try:
+            playbooks = read_json_file(self.playbook_path)
+            for scripts in playbooks.values():
+                for entry in scripts.values():
+                    with_epoch(entry)
+            return playbooks
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️  Failed to load playbooks: {e}")
+            return {}
+        
+        # First start: seed from the per-booking caches, newest script per milestone wins
+        playbooks = {}
+        for cache_path, carrier, booking_id in booking_cache_files(self.cache_dir):
+            try:
+                cache_data = read_json_file(cache_path)
+            except Exception:
+                continue
+            for milestone, entry in cache_data.get("milestones", {}).items():
+                script = entry.get("script")
+                if not script or booking_id in script:
+                    continue
+                current = playbooks.setdefault(carrier, {}).get(milestone)
+                if not current or entry.get("cached_at", "") > current["cached_at"]:
+                    playbooks[carrier][milestone] = with_epoch({"cached_at": entry.get("cached_at", "2000-01-01"), "script": script})
+        return playbooks
+    
+    def get_playbook_entry(self, carrier, milestone):
+        """Get the carrier playbook script for a milestone, if it is still fresh."""
+        entry = self.playbooks.get(carrier, {}).get(milestone)
+        if not entry or not entry.get("script"):
+            return None
+        if time.time() - entry["cached_at_epoch"] >= self.cache_ttl_days * 86400:
+            return None
+        print(f"📘 Found playbook script for '{milestone}' ({carrier})")
+        return {**entry, "playbook": True}
+    
+    def _update_playbook(self, carrier, booking_id, milestone, script):
+        # Scripts with the booking ID baked in only work for that booking
+        if booking_id and booking_id in script:
+            return
+        with self._playbook_lock:
+            self.playbooks.setdefault(carrier, {})[milestone] = {
+                "cached_at": datetime.now().isoformat(),
+                "cached_at_epoch": time.time(),
+                "script": script
+            }
+            # Snapshot so the writer thread never serializes a dict that is being updated
+            self._queue_write(self.playbook_path, {name: dict(scripts) for name, scripts in self.playbooks.items()})
+    
+    def _index(self):
+        """SQLite connection for the calling thread (sqlite3 connections are not shared across threads)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS milestones (
+                carrier TEXT NOT NULL,
+                milestone TEXT NOT NULL,
+                booking_id TEXT NOT NULL,
+                script TEXT NOT NULL,
+                operations TEXT,
+                dom_signature TEXT,
+                cached_at TEXT NOT NULL,
+                PRIMARY KEY (carrier, milestone, booking_id)
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS milestones_cached_at ON milestones (cached_at)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS final_results (
+                carrier TEXT NOT NULL,
+                booking_id TEXT NOT NULL,
+                voyage_number TEXT,
+                arrival_date TEXT,
+                verification_scripts TEXT,
+                cached_at TEXT NOT NULL,
+                PRIMARY KEY (carrier, booking_id)
+            )""")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < 2:
+                self._backfill_index(conn)
+            self._purge_expired(conn)
+            self._local.conn = conn
+        return conn
+    
+    def _oldest_valid(self):
+        return (datetime.now() - timedelta(days=self.cache_ttl_days)).isoformat()
+    
+    def _purge_expired(self, conn):
+        """Drop rows past the TTL in one statement per table (the JSON files keep the history)."""
+        oldest_valid = self._oldest_valid()
+        with conn:
+            conn.execute("DELETE FROM milestones WHERE cached_at <= ?", (oldest_valid,))
+            conn.execute("DELETE FROM final_results WHERE cached_at <= ?", (oldest_valid,))
+    
+    def _backfill_index(self, conn):
+        """Index milestones from JSON cache files written before the index existed."""
+        for cache_path, carrier, booking_id in booking_cache_files(self.cache_dir):
+            try:
+                cache_data = read_json_file(cache_path)
+            except Exception:
+                continue
+            for milestone, entry in cache_data.get("milestones", {}).items():
+                if entry.get("script"):
+                    self._index_milestone(conn, carrier, booking_id, milestone, entry)
+            if cache_data.get("final_results"):
+                self._index_final_results(conn, carrier, booking_id, cache_data["final_results"])
+        conn.execute("PRAGMA user_version = 2")
+        conn.commit()
+    
+    def _index_milestone(self, conn, carrier, booking_id, milestone, entry):
+        dom_signature = entry.get("dom_signature")
+        conn.execute(
+            "INSERT OR REPLACE INTO milestones VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (carrier, milestone, booking_id, entry["script"], json.dumps(entry.get("operations") or []),
+             json.dumps(dom_signature) if dom_signature else None, entry.get("cached_at", datetime.now().isoformat()))
+        )
+    
+    def _index_final_results(self, conn, carrier, booking_id, final_results):
+        conn.execute(
+            "INSERT OR REPLACE INTO final_results VALUES (?, ?, ?, ?, ?, ?)",
+            (carrier, booking_id, final_results.get("voyage_number"), final_results.get("arrival_date"),
+             json.dumps(final_results.get("verification_scripts") or []), final_results.get("cached_at", datetime.now().isoformat()))
+        )
     
     def _get_cache_path(self, carrier, booking_id):
         """Get cache file path for a specific carrier:booking_id combination."""
-        cache_key = f"{carrier}_{booking_id}"
-        return self.cache_dir / f"{cache_key}.json"
+        return cache_file_path(str(self.cache_dir), carrier, booking_id)
+    
+    WRITE_COALESCE_SECONDS = 0.2
+    
+    def _queue_write(self, path, data):
+        with self._mem_lock:
+            self._pending_writes[path] = data
+            if self._writer_thread is None:
+                self._writer_thread = threading.Thread(target=self._writer, name="cache-writer", daemon=True)
+                self._writer_thread.start()
+        self._write_wakeup.set()
+    
+    def _writer(self):
+        while True:
+            self._write_wakeup.wait()
+            # Let a burst of saves land so each file is written once for all of them
+            time.sleep(self.WRITE_COALESCE_SECONDS)
+            self._write_wakeup.clear()
+            self.flush()
+    
+    def flush(self):
+        """Write every queued cache file now."""
+        with self._file_lock:
+            with self._mem_lock:
+                pending, self._pending_writes = self._pending_writes, {}
+            for path, data in pending.items():
+                try:
+                    # A plain .json next to it (e.g. a seed file tracked in the repo) is left
+                    # alone: _read tries the .json.zst first, so it is shadowed from now on
+                    write_json_file(path, data)
+                except Exception as e:
+                    print(f"⚠️  Failed to write cache file {path}: {e}")
+    
+    VACUUM_INTERVAL_SECONDS = 3600
+    
+    def _vacuum_loop(self):
+        while True:
+            self.vacuum()
+            time.sleep(self.VACUUM_INTERVAL_SECONDS)
+    
+    def vacuum(self):
+        """
+        Delete cache files untouched for longer than the TTL in one directory sweep.
+        A file's cached_at never postdates its last write, so an mtime past the TTL
+        means the entry has expired and the file need not be parsed to tell.
+        """
+        cutoff = time.time() - self.cache_ttl_days * 86400
+        removed = 0
+        try:
+            with self._file_lock:
+                with os.scandir(self.cache_dir) as entries:
+                    for entry in entries:
+                        parsed = parse_cache_file_name(entry.name)
+                        if not parsed or not entry.is_file():
+                            continue
+                        if entry.stat().st_mtime > cutoff:
+                            continue
+                        path = self.cache_dir / entry.name
+                        with self._mem_lock:
+                            if path in self._pending_writes:
+                                continue
+                            self._mem.pop(parsed, None)
+                        os.unlink(entry.path)
+                        removed += 1
+            self._purge_expired(self._index())
+        except Exception as e:
+            print(f"⚠️  Cache vacuum failed: {e}")
+            return 0
+        if removed:
+            print(f"🧹 Removed {removed} expired cache file(s)")
+        return removed
+    
+    def _read(self, carrier, booking_id):
+        """Decoded cache file for carrier:booking_id, from memory after the first read; None if there is none."""
+        key = (carrier, booking_id)
+        with self._mem_lock:
+            if key not in self._mem:
+                cache_path = self._get_cache_path(carrier, booking_id)
+                if cache_path in self._pending_writes:
+                    self._mem[key] = self._pending_writes[cache_path]
+                else:
+                    # Open directly rather than stat first: one syscall, and no window
+                    # between the check and the read
+                    cache_data = None
+                    for path in (cache_path, legacy_cache_file_path(cache_path)):
+                        if path is None:
+                            continue
+                        try:
+                            cache_data = read_json_file(path)
+                            break
+                        except FileNotFoundError:
+                            continue
+                    if cache_data is None:
+                        return None
+                    self._mem[key] = with_epoch(cache_data)
+            return self._mem[key]
+    
+    def _read_modify_write(self, carrier, booking_id, update):
+        """Apply update() to a copy of the booking's cache, publish it in memory and queue the file write."""
+        with self._mem_lock:
+            try:
+                current = self._read(carrier, booking_id)
+            except Exception:
+                current = None
+            if current is None:
+                current = {"cached_at": datetime.now().isoformat(), "cached_at_epoch": time.time(), "milestones": {}}
+            cache_data = {**current, "milestones": dict(current.get("milestones", {}))}
+            update(cache_data)
+            self._mem[(carrier, booking_id)] = cache_data
+            self._queue_write(self._get_cache_path(carrier, booking_id), cache_data)
+            return cache_data
+    
+    def _file_expired(self, carrier, booking_id):
+        """
+        True when the booking's file (not yet in memory) was last written more than the TTL
+        ago. cached_at is never newer than the last write, so the entry is expired without
+        reading a byte of it; fresher files still get the cached_at check after decoding.
+        """
+        cache_path = self._get_cache_path(carrier, booking_id)
+        with self._mem_lock:
+            if (carrier, booking_id) in self._mem or cache_path in self._pending_writes:
+                return False
+        for path in (cache_path, legacy_cache_file_path(cache_path)):
+            if path is None:
+                continue
+            try:
+                return time.time() - os.stat(path).st_mtime >= self.cache_ttl_days * 86400
+            except FileNotFoundError:
+                continue
+        return False
     
     def load_cache(self, carrier, booking_id):
         """Load cache for a specific carrier:booking_id."""
-        cache_path = self._get_cache_path(carrier, booking_id)
-        
-        if not cache_path.exists():
-            return None
-        
         try:
-            with open(cache_path, 'r') as f:
-                cache_data = json.load(f)
+            if self._file_expired(carrier, booking_id):
+                print(f"⏰ Cache expired for {carrier}:{booking_id} (file untouched for {self.cache_ttl_days}+ days)")
+                return None
+            cache_data = self._read(carrier, booking_id)
+            if cache_data is None:
+                return None
             
-            cached_at = datetime.fromisoformat(cache_data.get("cached_at", "2000-01-01"))
-            age = datetime.now() - cached_at
+            age_days = int((time.time() - cache_data["cached_at_epoch"]) // 86400)
             
-            if age.days >= self.cache_ttl_days:
-                print(f"⏰ Cache expired for {carrier}:{booking_id} (age: {age.days} days)")
+            if age_days >= self.cache_ttl_days:
+                print(f"⏰ Cache expired for {carrier}:{booking_id} (age: {age_days} days)")
+                with self._mem_lock:
+                    self._mem.pop((carrier, booking_id), None)
                 return None
             
-            print(f"✨ Found cache for {carrier}:{booking_id} (age: {age.days} days)")
+            print(f"✨ Found cache for {carrier}:{booking_id} (age: {age_days} days)")
             return cache_data
             
         except Exception as e:
@@ -79,75 +558,182 @@ class MilestoneCache:
             return None
     
     def get_milestone_cache(self, carrier, booking_id, milestone):
-        """Get cached script for a specific milestone."""
-        cache = self.load_cache(carrier, booking_id)
-        
-        if not cache:
+        """Get cached script for a specific milestone (one primary-key lookup in the index)."""
+        try:
+            row = self._index().execute(
+                """SELECT script, operations, dom_signature, cached_at FROM milestones
+                   WHERE carrier = ? AND milestone = ? AND booking_id = ? AND cached_at > ?""",
+                (carrier, milestone, booking_id, self._oldest_valid())
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"⚠️  Milestone index lookup failed, reading cache file: {e}")
+            try:
+                cache = self._read(carrier, booking_id)
+            except Exception as read_error:
+                print(f"⚠️  Failed to load cache: {read_error}")
+                return None
+            entry = cache.get("milestones", {}).get(milestone) if cache else None
+            # Same per-milestone TTL as the index query, not load_cache's whole-file one
+            if entry and entry.get("cached_at", "") > self._oldest_valid():
+                return entry
             return None
         
-        milestones = cache.get("milestones", {})
-        return milestones.get(milestone)
+        return self._entry_from_row(row) if row else None
+    
+    def _entry_from_row(self, row):
+        script, operations, signature_json, cached_at = row
+        entry = {
+            "cached_at": cached_at,
+            "script": script,
+            "operations": json.loads(operations) if operations else []
+        }
+        if signature_json:
+            entry["dom_signature"] = json.loads(signature_json)
+        return entry
     
     def clear_cache(self, carrier, booking_id):
         """Clear cache file for a specific carrier:booking_id."""
         cache_path = self._get_cache_path(carrier, booking_id)
-        if cache_path.exists():
+        with self._file_lock:
+            with self._mem_lock:
+                # A queued write would otherwise bring the file back
+                was_pending = self._pending_writes.pop(cache_path, None) is not None
+                self._mem.pop((carrier, booking_id), None)
+            removed = was_pending
             try:
-                cache_path.unlink()
-                print(f"🗑️  Cleared cache for {carrier}:{booking_id}")
-                return True
+                for path in (cache_path, legacy_cache_file_path(cache_path)):
+                    if path is None:
+                        continue
+                    try:
+                        path.unlink()
+                        removed = True
+                    except FileNotFoundError:
+                        pass
             except Exception as e:
                 print(f"⚠️  Failed to clear cache: {e}")
                 return False
-        return False
+            if not removed:
+                return False
+            print(f"🗑️  Cleared cache for {carrier}:{booking_id}")
+        
+        try:
+            with self._index() as conn:
+                conn.execute("DELETE FROM milestones WHERE carrier = ? AND booking_id = ?", (carrier, booking_id))
+                conn.execute("DELETE FROM final_results WHERE carrier = ? AND booking_id = ?", (carrier, booking_id))
+        except sqlite3.Error as e:
+            print(f"⚠️  Failed to clear milestone index: {e}")
+        return True
     
     def cache_exists(self, carrier, booking_id):
         """Check if cache file exists (even if expired)."""
         cache_path = self._get_cache_path(carrier, booking_id)
-        return cache_path.exists()
+        if cache_path in self._pending_writes or cache_path.exists():
+            return True
+        legacy_path = legacy_cache_file_path(cache_path)
+        return bool(legacy_path and legacy_path.exists())
     
-    def save_milestone(self, carrier, booking_id, milestone, script, operations=None):
-        """Save a successful milestone script to cache."""
-        cache_path = self._get_cache_path(carrier, booking_id)
+    def find_similar_milestone(self, carrier, milestone, dom_signature, exclude_booking_id=None, min_similarity=0.85):
+        """
+        Find a script cached for the same carrier and milestone under another booking,
+        recorded on a structurally similar page. Carrier pages look the same for every
+        booking, so a new booking can replay a known script instead of going through
+        reasoning, vision and code generation.
+        """
+        if not dom_signature:
+            return None
         
-        if cache_path.exists():
-            try:
-                with open(cache_path, 'r') as f:
-                    cache_data = json.load(f)
-            except:
-                cache_data = {"cached_at": datetime.now().isoformat(), "milestones": {}}
-        else:
-            cache_data = {"cached_at": datetime.now().isoformat(), "milestones": {}}
+        current_signature = set(dom_signature)
+        best_entry = None
+        best_similarity = 0.0
+        
+        try:
+            rows = self._index().execute(
+                """SELECT script, operations, dom_signature, cached_at, booking_id FROM milestones
+                   WHERE carrier = ? AND milestone = ? AND booking_id != ?
+                   AND dom_signature IS NOT NULL AND cached_at > ?""",
+                (carrier, milestone, exclude_booking_id or "", self._oldest_valid())
+            ).fetchall()
+        except sqlite3.Error as e:
+            print(f"⚠️  Milestone index lookup failed: {e}")
+            return None
         
-        if "milestones" not in cache_data:
-            cache_data["milestones"] = {}
+        for row in rows:
+            # Scripts with their own booking ID baked in would submit that booking's query
+            # (same rule as _update_playbook)
+            if row[4] and row[4] in (row[0] or ""):
+                continue
+            similarity = dom_signature_similarity(current_signature, json.loads(row[2]))
+            if similarity > best_similarity:
+                best_entry = self._entry_from_row(row[:4])
+                best_similarity = similarity
         
-        cache_data["milestones"][milestone] = {
+        if best_entry and best_similarity >= min_similarity:
+            print(f"🧭 Found similar cached script for '{milestone}' (similarity: {best_similarity:.2f})")
+            return {**best_entry, "similarity": round(best_similarity, 3)}
+        return None
+    
+    def save_milestone(self, carrier, booking_id, milestone, script, operations=None, dom_signature=None):
+        """Save a successful milestone script to cache."""
+        entry = {
             "cached_at": datetime.now().isoformat(),
             "script": script,
             "operations": operations or []
         }
+        if dom_signature:
+            entry["dom_signature"] = sorted(dom_signature)
+        
+        def add_milestone(cache_data):
+            cache_data["milestones"][milestone] = entry
         
         try:
-            with open(cache_path, 'w') as f:
-                json.dump(cache_data, f, indent=2)
+            self._read_modify_write(carrier, booking_id, add_milestone)
             print(f"💾 Cached milestone '{milestone}' for {carrier}:{booking_id}")
         except Exception as e:
             print(f"⚠️  Failed to save cache: {e}")
+            return
+        
+        try:
+            with self._index() as conn:
+                self._index_milestone(conn, carrier, booking_id, milestone, entry)
+        except sqlite3.Error as e:
+            print(f"⚠️  Failed to index cached milestone: {e}")
+        
+        self._update_playbook(carrier, booking_id, milestone, script)
     
     def save_final_results(self, carrier, booking_id, voyage_number, arrival_date, verification_scripts=None):
         """Save final results (voyage number and arrival date) to cache."""
-        cache_path = self._get_cache_path(carrier, booking_id)
+        final_results = {
+            "cached_at": datetime.now().isoformat(),
+            "voyage_number": voyage_number,
+            "arrival_date": arrival_date,
+            "verification_scripts": verification_scripts or []
+        }
         
-        if cache_path.exists():
-            try:
-                with open(cache_path, 'r') as f:
-                    cache_data = json.load(f)
-            except:
-                cache_data = {"cached_at": datetime.now().isoformat(), "milestones": {}}
-        else:
-            cache_data = {"cached_at": datetime.now().isoformat(), "milestones": {}}
+        def set_final_results(cache_data):
+            cache_data["final_results"] = final_results
         
+        try:
+            self._read_modify_write(carrier, booking_id, set_final_results)
+            print(f"💾 Cached final results for {carrier}:{booking_id}")
+        except Exception as e:
+            print(f"⚠️  Failed to save final results: {e}")
+            return
+        
+        try:
+            with self._index() as conn:
+                self._index_final_results(conn, carrier, booking_id, final_results)
+        except sqlite3.Error as e:
+            print(f"⚠️  Failed to index final results: {e}")
+
+
+def dom_signature_similarity(signature_a, signature_b):
+    """Jaccard similarity between two DOM signatures (collections of shingles)."""
+    set_a = signature_a if isinstance(signature_a, set) else set(signature_a)
+    set_b = signature_b if isinstance(signature_b, set) else set(signature_b)
+    if not set_a or not set_b:
+        return 0.0
+    return len(set_a & set_b) / len(set_a | set_b)
+
 
 milestone_cache = MilestoneCache()
 
@@ -166,7 +752,8 @@ AUTOMATION_GUIDELINES = {
         "waits": {
             "prefer": "page.wait_for_load_state('load') - Waits for the load event (DOM + all resources loaded). This is recommended for most cases as it's practical for real-world sites with ads/analytics.",
             "element_waits": "Use page.wait_for_selector() before interaction",
-            "avoid": "Hard-coded time.sleep() unless necessary. Also avoid 'networkidle' as it often times out on sites with continuous background requests."
+            "avoid": "Hard-coded time.sleep() unless necessary. Also avoid unbounded 'networkidle' waits as they often time out on sites with continuous background requests.",
+            "settle_gate": "Before clicking, prefer page.wait_for_load_state('networkidle', timeout=1500) wrapped in try/except over fixed wait_for_timeout() sleeps - it returns as soon as the page is idle"
         },
         "actions": {
             "clicking": "Always scroll element into view first if needed",
@@ -291,12 +878,85 @@ RECOVERY_STRATEGIES = {
     }
 }
 
+# Static knowledge shared by every agent. It is serialized once here and sent as the
+# leading system message, byte-identical on every call, so OpenAI's prompt cache can
+# reuse it across the reasoning and language agents. CurrentContext.to_dict() carries
+# only per-run state and never repeats these sections.
+SHARED_KNOWLEDGE_PROMPT = (
+    "SHARED KNOWLEDGE BASE for the shipment tracking automation. The per-step context "
+    "you receive omits these sections; refer to them here.\n"
+    + json.dumps({
+        "workflow": DOMAIN_KNOWLEDGE["shipping_tracking_workflow"],
+        "common_patterns": DOMAIN_KNOWLEDGE["common_patterns"],
+        "automation_guidelines": AUTOMATION_GUIDELINES,
+        "recovery_strategies": RECOVERY_STRATEGIES
+    }, separators=(",", ":"))
+)
+
+# (context dict, its compact JSON) for the last context serialized into a prompt.
+# to_dict() hands back the same object until the context changes, so the reasoning
+# and language calls within a step share one encode.
+_last_context_json = (None, None)
+
+# Context fields the agent prompts actually refer to; screenshot paths, the last script's
+# source and the recent_step_data duplicate of history[-1] are left out of the prompt
+PROMPT_CONTEXT_FIELDS = (
+    "goal", "booking_id", "carrier", "current_url", "last_achieved_milestone", "next_milestone",
+    "remaining_milestones", "last_intent", "last_response_status", "last_response_data",
+    "extracted_data", "vision_analysis_after_action", "failure_alert"
+)
+
+def prompt_history_entry(entry):
+    """A pipeline log entry cut down to what the agents use: where the step was and what failed."""
+    errors = []
+    for error in entry.get("errors") or []:
+        data = error.get("data")
+        message = data.get("error") if isinstance(data, dict) else data
+        errors.append({"operation": error.get("operation"), "error": str(message)[:200] if message else None})
+    return {
+        "step": entry.get("step"),
+        "milestone": entry.get("milestone"),
+        "current_url": entry.get("current_url"),
+        "success": entry.get("success"),
+        "errors": errors
+    }
+
+def project_context_for_prompt(context):
+    """The part of a context dict that goes into agent prompts (see PROMPT_CONTEXT_FIELDS)."""
+    projected = {field: context[field] for field in PROMPT_CONTEXT_FIELDS if field in context}
+    projected["history"] = [prompt_history_entry(entry) for entry in context.get("history") or []]
+    return projected
+
+def serialize_context(context):
+    """Compact JSON of the prompt fields of a context dict, reusing the previous encode for the same object."""
+    global _last_context_json
+    cached_context, cached_json = _last_context_json
+    if cached_context is context:
+        return cached_json
+    context_json = json.dumps(project_context_for_prompt(context), separators=(",", ":"), default=str)
+    _last_context_json = (context, context_json)
+    return context_json
+
 # ============================================================================
 # CURRENT CONTEXT CLASS
 # ============================================================================
 
+class ContextSnapshot(dict):
+    """
+    Read-only dict returned by CurrentContext.to_dict(). It is shared by every caller until
+    the context changes, so in-place edits raise instead of leaking into other prompts;
+    build a new dict ({**snapshot, ...}) to add keys. Still a dict, so json/orjson take it as is.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("context snapshot is read-only; copy it before adding keys")
+    
+    __setitem__ = __delitem__ = _read_only
+    update = pop = popitem = setdefault = clear = _read_only
+
+
 class CurrentContext:
     def __init__(self):
+        self._dict_cache = None  # to_dict() result, dropped whenever the context changes
         self.goal = None
         self.booking_id = None
         self.carrier = "hmm"
@@ -307,20 +967,32 @@ class CurrentContext:
         self.current_url = None
         self.last_achieved_milestone = None
         self.remaining_milestones = []  # Track remaining milestones as a task list
+        self.formatted_milestones = ()  # Full milestone list for this carrier, formatted once per run
+        self.milestone_index = {}
+        self.milestone_by_lower = {}  # Lowercased milestone -> milestone, for exact matches in update_milestone
         self.current_window_screenshot = None
         self.tab_screenshots = []
-        self.history = []
+        self.history = deque(maxlen=6)  # Last 6 step logs; older entries fall off the left
+        self.recent_error_flags = deque(maxlen=3)  # Whether each of the last 3 steps logged errors
+        self.recent_failure_keys = deque(maxlen=20)  # (milestone, first failing operation) per failed step
+        self.failure_counts = Counter()  # Occurrences of each key in recent_failure_keys
         self.extracted_data = {}
         self.vision_analysis_after_action = None
+        self.input_probes = {}  # (url, scroll x, scroll y, x, y) -> confirmed input probe; cleared after each script
     
     def set_goal(self, booking_id, carrier="hmm"):
         self.goal = f"Extract voyage number and arrival date for booking {booking_id}"
         self.booking_id = booking_id
         self.carrier = carrier.lower()
-        self.remaining_milestones = [
-            milestone.format(carrier=self.carrier.upper())
+        carrier_upper = self.carrier.upper()
+        # Interned: the same labels key the cache, the index and every step log
+        self.formatted_milestones = tuple(
+            sys.intern(milestone.format(carrier=carrier_upper))
             for milestone in DOMAIN_KNOWLEDGE["shipping_tracking_workflow"]["milestones"]
-        ]
+        )
+        self.milestone_index = {milestone: i for i, milestone in enumerate(self.formatted_milestones)}
+        self.milestone_by_lower = {sys.intern(milestone.lower()): milestone for milestone in self.formatted_milestones}
+        self.remaining_milestones = list(self.formatted_milestones)
     
     def update_script(self, script, intent):
         self.last_tried_script = script
@@ -340,26 +1012,62 @@ class CurrentContext:
     def update_url(self, url):
         self.current_url = url
     
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name != "_dict_cache":
+            super().__setattr__("_dict_cache", None)
+    
     def update_milestone(self, milestone):
         self.last_achieved_milestone = milestone
         if milestone and self.remaining_milestones:
             milestone_lower = milestone.lower()
+            exact = self.milestone_by_lower.get(milestone_lower)
+            if exact is not None and exact in self.remaining_milestones:
+                self.remaining_milestones.remove(exact)
+                self._dict_cache = None
+                return
+            # Agents sometimes paraphrase a milestone; fall back to substring matching
             for i, remaining in enumerate(self.remaining_milestones):
-                if remaining.lower() in milestone_lower or milestone_lower in remaining.lower():
+                remaining_lower = remaining.lower()
+                if remaining_lower in milestone_lower or milestone_lower in remaining_lower:
                     self.remaining_milestones.pop(i)
+                    self._dict_cache = None
                     break
     
     def update_screenshots(self, window_screenshot, tab_screenshots=None):
+        """Screenshots stay on disk; the context holds paths, never image bytes."""
         self.current_window_screenshot = window_screenshot
         if tab_screenshots:
             self.tab_screenshots = tab_screenshots
     
     def add_to_history(self, log_json):
         self.history.append(log_json)
-        if len(self.history) > 6:
-            self.history.pop(0)
+        self._dict_cache = None
+        self.recent_error_flags.append(bool(log_json.get("errors")))
+        if log_json.get("errors"):
+            if len(self.recent_failure_keys) == self.recent_failure_keys.maxlen:
+                evicted = self.recent_failure_keys[0]
+                self.failure_counts[evicted] -= 1
+                if not self.failure_counts[evicted]:
+                    del self.failure_counts[evicted]
+            failure_key = (log_json.get("milestone"), log_json["errors"][0].get("operation"))
+            self.recent_failure_keys.append(failure_key)
+            self.failure_counts[failure_key] += 1
+    
+    def update_extracted_data(self, data):
+        self.extracted_data.update(data)
+        self._dict_cache = None
     
     def to_dict(self):
+        """
+        Snapshot of the context for the agents. Built once and reused until something
+        changes (attribute assignment or one of the update methods), since each step asks
+        for it several times. The snapshot is read-only and holds copies of the mutable
+        fields, so later updates never show through in one already handed out.
+        """
+        if self._dict_cache is not None:
+            return self._dict_cache
+        
         recent_step_data = {}
         if self.history:
             most_recent = self.history[-1]
@@ -372,7 +1080,7 @@ class CurrentContext:
         
         next_milestone = self.remaining_milestones[0] if self.remaining_milestones else "Goal completion"
         
-        return {
+        self._dict_cache = ContextSnapshot({
             "goal": self.goal,
             "booking_id": self.booking_id,
             "carrier": self.carrier,
@@ -383,18 +1091,15 @@ class CurrentContext:
             "current_url": self.current_url,
             "last_achieved_milestone": self.last_achieved_milestone,
             "next_milestone": next_milestone,
-            "remaining_milestones": self.remaining_milestones,
+            "remaining_milestones": tuple(self.remaining_milestones),
             "current_window_screenshot": self.current_window_screenshot,
-            "tab_screenshots": self.tab_screenshots,
-            "history": self.history,
-            "extracted_data": self.extracted_data,
+            "tab_screenshots": [shot["path"] if isinstance(shot, dict) else shot for shot in self.tab_screenshots],
+            "history": list(self.history),
+            "extracted_data": dict(self.extracted_data),
             "vision_analysis_after_action": self.vision_analysis_after_action,
-            "recent_step_data": recent_step_data,
-            "workflow": DOMAIN_KNOWLEDGE["shipping_tracking_workflow"],
-            "common_patterns": DOMAIN_KNOWLEDGE["common_patterns"],
-            "automation_guidelines": AUTOMATION_GUIDELINES,
-            "recovery_strategies": RECOVERY_STRATEGIES
-        }
+            "recent_step_data": recent_step_data
+        })
+        return self._dict_cache
     
     def reset(self):
         self.__init__()
@@ -404,11 +1109,154 @@ class CurrentContext:
 # VISION HELPERS CLASS
 # ============================================================================
 
+# Vision-bound screenshots are JPEG (a fraction of the PNG upload size, same viewport
+# pixels so vision coordinates still map 1:1). DEBUG_SCREENSHOTS=1 keeps lossless PNGs.
+DEBUG_SCREENSHOTS = os.environ.get("DEBUG_SCREENSHOTS", "0") == "1"
+SCREENSHOT_EXT = "png" if DEBUG_SCREENSHOTS else "jpg"
+JPEG_QUALITY = 75
+
+def screenshot_format_options(path):
+    """Extra page.screenshot() kwargs for the file type implied by the path."""
+    if str(path).lower().endswith((".jpg", ".jpeg")):
+        return {"type": "jpeg", "quality": JPEG_QUALITY}
+    return {}
+
+# Above this page height, capture fold by fold instead of one full-page image (Chromium
+# caps screenshot textures around 16k px)
+FULL_PAGE_CAPTURE_MAX_HEIGHT = 15000
+
+# Coordinate clicks go through Playwright's mouse (viewport coordinates, no X11 round trip);
+# USE_PYAUTOGUI=1 restores OS-level clicks for sites that only react to real pointer input
+USE_PYAUTOGUI = os.environ.get("USE_PYAUTOGUI", "0") == "1"
+
+def image_mime_type(path):
+    return "image/jpeg" if str(path).lower().endswith((".jpg", ".jpeg")) else "image/png"
+
+def image_data_url(image_bytes, mime_type="image/jpeg"):
+    """Inline data: URL for an image; base64 output is ASCII, so it is decoded as such in one pass."""
+    return "".join(("data:", mime_type, ";base64,", base64.b64encode(image_bytes).decode("ascii")))
+
+@lru_cache(maxsize=8)
+def _screenshot_data_url(path, mtime_ns):
+    return image_data_url(Path(path).read_bytes(), image_mime_type(path))
+
+def screenshot_data_url(path):
+    """
+    data: URL for a screenshot file. The same screenshot is often sent to vision more than
+    once in a step, so the encode is reused until the file's mtime changes.
+    """
+    wait_for_screenshot(path)
+    return _screenshot_data_url(str(path), os.stat(path).st_mtime_ns)
+
+def page_url_or(page, fallback="unknown"):
+    """
+    URL of a page, or the fallback once it is closed. page.url and is_closed() are kept
+    up to date by Playwright's event stream on the client side, so this never waits on
+    the browser and is fine to call as often as needed.
+    """
+    return page.url if not page.is_closed() else fallback
+
+def url_domain(url):
+    """Lowercased host of a URL (the whole string lowercased if it doesn't parse)."""
+    try:
+        return urlparse(url).netloc.lower()
+    except:
+        return url.lower()
+
+# Elements worth a computed-style check when looking for popups: inline z-index, modal-ish
+# class names and dialog roles. close_popup only scans the whole DOM if none of these match.
+POPUP_HINT_SELECTOR = ", ".join([
+    '[style*="z-index"]',
+    '[class*="modal" i]',
+    '[class*="popup" i]',
+    '[class*="overlay" i]',
+    '[class*="dialog" i]',
+    'dialog[open]',
+    '[role="dialog"]',
+    '[aria-modal="true"]',
+])
+
+# Installed on the browser context so it runs at document start on every page: a
+# MutationObserver keeps the set of positioned, high z-index elements current as the page
+# changes, computing styles only for nodes that were added or restyled (batched per frame).
+# close_popup reads this set before falling back to selector scans. Computed styles can also
+# change with no mutation (a late stylesheet), which is why the scans remain as fallbacks.
+POPUP_TRACKER_INIT_SCRIPT = """
+(() => {
+    if (window.__popupTracker) return;
+    const candidates = new Set();
+    const pending = new Set();
+    let scheduled = false;
+    const consider = (el) => {
+        const { zIndex, position } = window.getComputedStyle(el);
+        if ((parseInt(zIndex) || 0) > 100 && (position === 'fixed' || position === 'absolute')) {
+            candidates.add(el);
+        } else {
+            candidates.delete(el);
+        }
+    };
+    const flush = () => {
+        scheduled = false;
+        for (const el of pending) {
+            if (el.isConnected) consider(el);
+        }
+        pending.clear();
+    };
+    const queue = (el) => {
+        pending.add(el);
+        if (!scheduled) {
+            scheduled = true;
+            requestAnimationFrame(flush);
+        }
+    };
+    new MutationObserver((records) => {
+        for (const record of records) {
+            if (record.type === 'attributes') {
+                queue(record.target);
+                continue;
+            }
+            for (const node of record.addedNodes) {
+                if (node.nodeType !== Node.ELEMENT_NODE) continue;
+                queue(node);
+                for (const child of node.querySelectorAll('*')) queue(child);
+            }
+        }
+    }).observe(document, { subtree: true, childList: true, attributes: true, attributeFilter: ['style', 'class'] });
+    window.__popupTracker = { candidates, flush };
+})();
+"""
+
 class VisionHelpers:
     def __init__(self, page):
+        self._cdp_session = None
+        self._viewport = None
         self.page = page
         self.popup_closed_by_click = False  # Track if popups were closed by click_at_coordinates
     
+    @property
+    def page(self):
+        return self._page
+    
+    @page.setter
+    def page(self, page):
+        # Per-page state has to follow tab switches
+        self._page = page
+        self._cdp_session = None
+        self._viewport = None
+    
+    def cdp_session(self):
+        """CDP session for the current page, opened on first use and kept until the page changes."""
+        if self._cdp_session is None:
+            self._cdp_session = self.page.context.new_cdp_session(self.page)
+        return self._cdp_session
+    
+    def install_page_observers(self):
+        """Register the popup tracker init script on the page's context (effective from the next navigation)."""
+        try:
+            self.page.context.add_init_script(POPUP_TRACKER_INIT_SCRIPT)
+        except Exception as e:
+            print(f"⚠️  Could not install page observer script: {e}")
+    
     def close_popup(self):
         """
         Attempts to close any popup/modal/overlay using metadata-driven detection.
@@ -417,153 +1265,265 @@ class VisionHelpers:
         """
         print("\n🚪 Attempting to close popup/modal...")
         
+        # Most pages have no popup. Give one up to 500ms to show up (the grace period this
+        # used to sleep unconditionally) and stop there if none does, skipping Escape and the scan
         try:
-            self.page.wait_for_timeout(500)
-        except:
+            self.page.wait_for_function("""
+                (hintSelector) => {
+                    const sizable = (el) => {
+                        const rect = el.getBoundingClientRect();
+                        return rect.width > 100 && rect.height > 50;
+                    };
+                    const overlayLike = (el) => {
+                        const { zIndex, position, display, visibility } = window.getComputedStyle(el);
+                        return (parseInt(zIndex) || 0) > 100 &&
+                            (position === 'fixed' || position === 'absolute') &&
+                            display !== 'none' && visibility !== 'hidden' && sizable(el);
+                    };
+                    for (const el of document.querySelectorAll('dialog[open], [aria-modal="true"], [role="dialog"]')) {
+                        if (sizable(el)) return true;
+                    }
+                    const tracker = window.__popupTracker;
+                    if (tracker) {
+                        tracker.flush();
+                        for (const el of tracker.candidates) {
+                            if (el.isConnected && overlayLike(el)) return true;
+                        }
+                    }
+                    for (const el of document.querySelectorAll(hintSelector)) {
+                        if (overlayLike(el)) return true;
+                    }
+                    return false;
+                }
+            """, arg=POPUP_HINT_SELECTOR, timeout=500, polling=100)
+        except PlaywrightTimeoutError:
+            print("  ℹ️  No popup-like element on the page, nothing to close")
+            return False
+        except Exception:
             pass
         
         try:
             self.page.keyboard.press("Escape")
-            self.page.wait_for_timeout(500)
             print("  ✅ Tried Escape key")
         except Exception:
             pass
         
         try:
+            # The detection script waits out the Escape key's repaint itself (two frames,
+            # 500ms at most), so settling and scanning share one round trip
             popup_info = self.page.evaluate("""
-                () => {
-                    const allElements = document.querySelectorAll('*');
-                    const popups = [];
+                async (hintSelector) => {
+                    await new Promise(resolve => {
+                        setTimeout(resolve, 500);
+                        requestAnimationFrame(() => requestAnimationFrame(resolve));
+                    });
                     
-                    for (const el of allElements) {
-                        const style = window.getComputedStyle(el);
-                        const rect = el.getBoundingClientRect();
+                    // Computed styles are live objects, so one per element is kept on the
+                    // window and shared with the re-check after each click
+                    const styleCache = window.__popupStyleCache || (window.__popupStyleCache = new WeakMap());
+                    const cs = (el) => {
+                        let style = styleCache.get(el);
+                        if (!style) {
+                            style = window.getComputedStyle(el);
+                            styleCache.set(el, style);
+                        }
+                        return style;
+                    };
+                    // Layout is fixed for the duration of this scan; the fallback walk revisits hinted elements
+                    const rectCache = new Map();
+                    const rectOf = (el) => {
+                        let rect = rectCache.get(el);
+                        if (!rect) {
+                            rect = el.getBoundingClientRect();
+                            rectCache.set(el, rect);
+                        }
+                        return rect;
+                    };
+                    
+                    const findPopups = (candidates) => {
+                        const popups = [];
+                    
+                        for (const el of candidates) {
+                            const { zIndex: rawZIndex, position, display, visibility, opacity: rawOpacity } = cs(el);
+                            const rect = rectOf(el);
                         
-                        // Check if element has popup-like characteristics
-                        const zIndex = parseInt(style.zIndex) || 0;
-                        const position = style.position;
-                        const display = style.display;
-                        const visibility = style.visibility;
-                        const opacity = parseFloat(style.opacity);
+                            // Check if element has popup-like characteristics
+                            const zIndex = parseInt(rawZIndex) || 0;
+                            const opacity = parseFloat(rawOpacity);
                         
-                        // Popup indicators:
-                        // 1. High z-index (usually > 1000 for popups)
-                        // 2. Fixed or absolute positioning
-                        // 3. Visible and displayed
-                        // 4. Has significant size (not tiny)
-                        const isPopupLike = (
-                            (zIndex > 1000 || zIndex > 100) &&
-                            (position === 'fixed' || position === 'absolute') &&
-                            display !== 'none' &&
-                            visibility !== 'hidden' &&
-                            opacity > 0.5 &&
-                            rect.width > 100 &&
-                            rect.height > 50
-                        );
+                            // Popup indicators:
+                            // 1. High z-index (usually > 1000 for popups)
+                            // 2. Fixed or absolute positioning
+                            // 3. Visible and displayed
+                            // 4. Has significant size (not tiny)
+                            const isPopupLike = (
+                                (zIndex > 1000 || zIndex > 100) &&
+                                (position === 'fixed' || position === 'absolute') &&
+                                display !== 'none' &&
+                                visibility !== 'hidden' &&
+                                opacity > 0.5 &&
+                                rect.width > 100 &&
+                                rect.height > 50
+                            );
                         
-                        if (isPopupLike) {
-                            // Find buttons within this popup element
-                            const buttons = el.querySelectorAll('button');
-                            const closeButtonCandidates = [];
+                            if (isPopupLike) {
+                                // Find buttons within this popup element
+                                const buttons = el.querySelectorAll('button');
+                                const closeButtonCandidates = [];
                             
-                            for (const btn of buttons) {
-                                const btnRect = btn.getBoundingClientRect();
-                                const btnText = btn.textContent.trim();
+                                for (const btn of buttons) {
+                                    const btnRect = btn.getBoundingClientRect();
+                                    const btnText = btn.textContent.trim();
                                 
-                                // Close button indicators:
-                                // 1. Usually small (not a main action button)
-                                // 2. Often positioned in top-right corner of popup
-                                // 3. May have specific text or be icon-only
-                                const isSmallButton = btnRect.width < 100 && btnRect.height < 100;
-                                const isInTopRight = (
-                                    btnRect.right > rect.right - 50 &&  // Near right edge
-                                    btnRect.top < rect.top + 100        // Near top
-                                );
+                                    // Close button indicators:
+                                    // 1. Usually small (not a main action button)
+                                    // 2. Often positioned in top-right corner of popup
+                                    // 3. May have specific text or be icon-only
+                                    const isSmallButton = btnRect.width < 100 && btnRect.height < 100;
+                                    const isInTopRight = (
+                                        btnRect.right > rect.right - 50 &&  // Near right edge
+                                        btnRect.top < rect.top + 100        // Near top
+                                    );
                                 
-                                if (isSmallButton || isInTopRight || btnText.length < 10) {
-                                    closeButtonCandidates.push({
-                                        text: btnText,
-                                        x: btnRect.x + btnRect.width / 2,
-                                        y: btnRect.y + btnRect.height / 2,
-                                        zIndex: zIndex
-                                    });
+                                    if (isSmallButton || isInTopRight || btnText.length < 10) {
+                                        closeButtonCandidates.push({
+                                            text: btnText,
+                                            x: btnRect.x + btnRect.width / 2,
+                                            y: btnRect.y + btnRect.height / 2,
+                                            zIndex: zIndex
+                                        });
+                                    }
                                 }
-                            }
                             
-                            if (closeButtonCandidates.length > 0) {
-                                popups.push({
-                                    zIndex: zIndex,
-                                    rect: {
-                                        x: rect.x,
-                                        y: rect.y,
-                                        width: rect.width,
-                                        height: rect.height
-                                    },
-                                    closeButtons: closeButtonCandidates
-                                });
+                                if (closeButtonCandidates.length > 0) {
+                                    popups.push({
+                                        zIndex: zIndex,
+                                        rect: {
+                                            x: rect.x,
+                                            y: rect.y,
+                                            width: rect.width,
+                                            height: rect.height
+                                        },
+                                        closeButtons: closeButtonCandidates
+                                    });
+                                }
                             }
                         }
+                        return popups;
+                    };
+                    
+                    // Elements the popup tracker has seen turn into overlays first, then the
+                    // hinted elements; walk everything only if neither turns anything up
+                    let scope = null;
+                    let popups = [];
+                    const tracker = window.__popupTracker;
+                    if (tracker) {
+                        tracker.flush();
+                        scope = '@tracker';
+                        popups = findPopups([...tracker.candidates].filter(el => el.isConnected));
+                    }
+                    if (popups.length === 0) {
+                        scope = hintSelector;
+                        popups = findPopups(document.querySelectorAll(hintSelector));
+                    }
+                    if (popups.length === 0) {
+                        // Last resort: walk the rendered tree, pruning whole subtrees that
+                        // can't hold an overlay (non-visual tags, display:none) before any
+                        // computed-style lookup, instead of materializing every element
+                        const NON_VISUAL = new Set(['SCRIPT', 'STYLE', 'NOSCRIPT', 'TEMPLATE', 'LINK', 'META', 'svg']);
+                        const walker = document.createTreeWalker(document.body || document.documentElement, NodeFilter.SHOW_ELEMENT, {
+                            acceptNode: (el) => {
+                                if (NON_VISUAL.has(el.tagName)) return NodeFilter.FILTER_REJECT;
+                                if (el.getClientRects().length > 0) return NodeFilter.FILTER_ACCEPT;
+                                // No boxes: hidden subtree, unless display:contents passes its children through
+                                return el.childElementCount && cs(el).display === 'contents'
+                                    ? NodeFilter.FILTER_SKIP
+                                    : NodeFilter.FILTER_REJECT;
+                            }
+                        });
+                        const rendered = [];
+                        while (walker.nextNode()) rendered.push(walker.currentNode);
+                        scope = '*';
+                        popups = findPopups(rendered);
                     }
                     
                     // Sort by z-index (highest first - most likely to be the visible popup)
                     popups.sort((a, b) => b.zIndex - a.zIndex);
                     
-                    return popups.length > 0 ? {
-                        found: true,
-                        popups: popups.map(p => ({
-                            zIndex: p.zIndex,
-                            rect: p.rect,
-                            closeButtons: p.closeButtons.map(btn => ({
-                                text: btn.text,
-                                x: Math.round(btn.x),
-                                y: Math.round(btn.y)
-                            }))
-                        }))
-                    } : { found: false };
+                    if (popups.length === 0) {
+                        return { found: false };
+                    }
+                    
+                    // Flat columns rather than nested objects: a smaller payload and far fewer
+                    // objects to rebuild on the Python side. Buttons are listed popup by popup,
+                    // buttonPopup[i] is the index of button i's popup in zIndexes.
+                    const zIndexes = [], buttonPopup = [], xs = [], ys = [], texts = [];
+                    popups.forEach((p, popupIdx) => {
+                        zIndexes.push(p.zIndex);
+                        for (const btn of p.closeButtons) {
+                            buttonPopup.push(popupIdx);
+                            xs.push(Math.round(btn.x));
+                            ys.push(Math.round(btn.y));
+                            texts.push(btn.text);
+                        }
+                    });
+                    return { found: true, scope, zIndexes, buttonPopup, xs, ys, texts };
                 }
-            """)
+            """, POPUP_HINT_SELECTOR)
             
-            if popup_info.get("found") and len(popup_info.get("popups", [])) > 0:
-                print(f"  🔍 Found {len(popup_info['popups'])} popup-like element(s) using metadata detection")
+            if popup_info.get("found") and popup_info.get("zIndexes"):
+                z_indexes = popup_info["zIndexes"]
+                print(f"  🔍 Found {len(z_indexes)} popup-like element(s) using metadata detection")
+                # Re-check over the same element set the popups were found in
+                recheck_selector = popup_info.get("scope", "*")
                 
-                for popup_idx, popup in enumerate(popup_info["popups"]):
-                    print(f"  📋 Popup {popup_idx + 1} (z-index {popup['zIndex']}) has {len(popup['closeButtons'])} close button candidate(s)")
-                    
-                    target_z_index = popup["zIndex"]
+                buttons_by_popup = [[] for _ in z_indexes]
+                for button_idx, owner_idx in enumerate(popup_info["buttonPopup"]):
+                    buttons_by_popup[owner_idx].append(button_idx)
+                
+                for popup_idx, target_z_index in enumerate(z_indexes):
+                    button_indexes = buttons_by_popup[popup_idx]
+                    print(f"  📋 Popup {popup_idx + 1} (z-index {target_z_index}) has {len(button_indexes)} close button candidate(s)")
                     
-                    for btn_idx, close_btn in enumerate(popup["closeButtons"]):
+                    for btn_idx, button_idx in enumerate(button_indexes):
                         try:
-                            x, y = close_btn["x"], close_btn["y"]
-                            btn_text = close_btn["text"]
+                            x, y = popup_info["xs"][button_idx], popup_info["ys"][button_idx]
+                            btn_text = popup_info["texts"][button_idx]
                             print(f"  🖱️  Attempting to click button {btn_idx + 1} at ({x}, {y}) - text: '{btn_text}'")
                             
                             self.page.mouse.click(x, y)
-                            self.page.wait_for_timeout(2000)
                             
-                            remaining_popups_info = self.page.evaluate("""
-                                () => {
-                                    const allElements = document.querySelectorAll('*');
-                                    const visiblePopups = [];
-                                    for (const el of allElements) {
-                                        const style = window.getComputedStyle(el);
-                                        const zIndex = parseInt(style.zIndex) || 0;
-                                        const rect = el.getBoundingClientRect();
-                                        if (zIndex > 1000 && 
-                                            style.display !== 'none' && 
-                                            style.visibility !== 'hidden' &&
-                                            rect.width > 100 &&
-                                            rect.height > 50) {
-                                            visiblePopups.push(zIndex);
+                            # One round trip that resolves as soon as the popup's z-index layer
+                            # is gone, instead of a fixed 2s sleep followed by a re-check
+                            try:
+                                self.page.wait_for_function("""
+                                    ([selector, targetZIndex]) => {
+                                        const styleCache = window.__popupStyleCache || (window.__popupStyleCache = new WeakMap());
+                                        const elements = selector === '@tracker'
+                                            ? [...window.__popupTracker.candidates].filter(el => el.isConnected)
+                                            : document.querySelectorAll(selector);
+                                        for (const el of elements) {
+                                            let style = styleCache.get(el);
+                                            if (!style) {
+                                                style = window.getComputedStyle(el);
+                                                styleCache.set(el, style);
+                                            }
+                                            const { zIndex: rawZIndex, display, visibility } = style;
+                                            const zIndex = parseInt(rawZIndex) || 0;
+                                            if (zIndex <= 1000 || zIndex !== targetZIndex || display === 'none' || visibility === 'hidden') {
+                                                continue;
+                                            }
+                                            const rect = el.getBoundingClientRect();
+                                            if (rect.width > 100 && rect.height > 50) {
+                                                return false;
+                                            }
                                         }
+                                        return true;
                                     }
-                                    return visiblePopups;
-                                }
-                            """)
-                            
-                            if target_z_index not in remaining_popups_info:
+                                """, arg=[recheck_selector, target_z_index], timeout=2000, polling=100)
                                 print(f"  ✅ Successfully closed popup (z-index {target_z_index} disappeared)!")
                                 return True
-                            else:
+                            except PlaywrightTimeoutError:
                                 print(f"  ⚠️  Popup still visible, trying next button...")
                                 
                         except Exception as e:
@@ -580,36 +1540,42 @@ class VisionHelpers:
         
         print("  🔍 Trying position-based close button detection...")
         try:
-            viewport = self.page.viewport_size or {"width": 1280, "height": 720}
+            viewport = self.viewport()
             close_positions = [
-                (viewport["width"] - 50, 50),
-                (viewport["width"] - 100, 50),
-                (viewport["width"] - 50, 100),
+                [viewport["width"] - 50, 50],
+                [viewport["width"] - 100, 50],
+                [viewport["width"] - 50, 100],
             ]
             
-            for x, y in close_positions:
+            # Probe all corner positions in one round trip; buttons come back in position order
+            buttons_at_positions = self.page.evaluate("""
+                (points) => {
+                    const found = [];
+                    for (const [x, y] of points) {
+                        const el = document.elementFromPoint(x, y);
+                        if (el && el.tagName === 'BUTTON') {
+                            const rect = el.getBoundingClientRect();
+                            found.push({
+                                probeX: x,
+                                probeY: y,
+                                text: el.textContent.trim(),
+                                x: rect.x + rect.width / 2,
+                                y: rect.y + rect.height / 2
+                            });
+                        }
+                    }
+                    return found;
+                }
+            """, close_positions)
+            
+            for element_at_pos in buttons_at_positions:
                 try:
-                    element_at_pos = self.page.evaluate(f"""
-                        () => {{
-                            const el = document.elementFromPoint({x}, {y});
-                            if (el && el.tagName === 'BUTTON') {{
-                                return {{
-                                    text: el.textContent.trim(),
-                                    x: el.getBoundingClientRect().x + el.getBoundingClientRect().width / 2,
-                                    y: el.getBoundingClientRect().y + el.getBoundingClientRect().height / 2
-                                }};
-                            }}
-                            return null;
-                        }}
-                    """)
-                    
-                    if element_at_pos:
-                        btn_x, btn_y = int(element_at_pos["x"]), int(element_at_pos["y"])
-                        print(f"  🖱️  Found button at ({x}, {y}), clicking at ({btn_x}, {btn_y})")
-                        self.page.mouse.click(btn_x, btn_y)
-                        self.page.wait_for_timeout(500)
-                        print(f"  ✅ Clicked button at position")
-                        return True
+                    btn_x, btn_y = int(element_at_pos["x"]), int(element_at_pos["y"])
+                    print(f"  🖱️  Found button at ({element_at_pos['probeX']}, {element_at_pos['probeY']}), clicking at ({btn_x}, {btn_y})")
+                    self.page.mouse.click(btn_x, btn_y)
+                    self.settle_frames(500)
+                    print(f"  ✅ Clicked button at position")
+                    return True
                 except Exception:
                     continue
         except Exception:
@@ -620,77 +1586,142 @@ class VisionHelpers:
         return False
     
     def take_screenshot(self, path, timeout=30000):
+        """Capture the viewport and return the path right away; the file is written in the background."""
         try:
-            self.page.screenshot(
-                path=path, 
+            image_bytes = self.page.screenshot(
                 full_page=False, 
                 timeout=timeout, 
                 animations="disabled",
-                caret="hide"  # Hide blinking caret to prevent blocking
+                caret="hide",  # Hide blinking caret to prevent blocking
+                **screenshot_format_options(path)
             )
+            write_screenshot_async(path, image_bytes)
             return path
         except Exception as e:
             print(f"⚠️  Screenshot error: {e}")
             raise
     
+    def flush(self):
+        """Wait for every queued screenshot write."""
+        for future in list(_pending_screenshot_writes.values()):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"⚠️  Screenshot write failed: {e}")
+    
     def take_multifold_screenshots(self, prefix, screenshot_dir, timeout=30000):
         if self.page.is_closed():
             raise Exception("Page is closed, cannot take screenshot")
         
-        viewport = self.page.viewport_size or {"width": 1280, "height": 720}
+        viewport = self.viewport()
         v_height = viewport["height"]
         
         try:
-            total_height = self.page.evaluate(
-                """() => Math.max(
-                    document.body.scrollHeight,
-                    document.documentElement.scrollHeight
-                )"""
-            )
+            page_size = self.get_page_size()
+            total_height = page_size["height"]
         except Exception as e:
             print(f"⚠️  Could not evaluate page height: {e}")
-            screenshot_path = self.take_screenshot(Path(screenshot_dir) / f"{prefix}_fold_01.png", timeout)
+            screenshot_path = self.take_screenshot(Path(screenshot_dir) / f"{prefix}_fold_01.{SCREENSHOT_EXT}", timeout)
             return [{"path": str(screenshot_path), "scroll_top": 0}]
         
         num_folds = max(1, math.ceil(total_height / v_height))
+        
+        # A full-page capture is as wide as the page, so pages that overflow sideways keep the scroll loop
+        if (num_folds > 1 and Image is not None and total_height <= FULL_PAGE_CAPTURE_MAX_HEIGHT
+                and page_size.get("width", 0) <= viewport["width"]):
+            try:
+                return self.crop_folds_from_full_page(prefix, screenshot_dir, viewport, total_height, num_folds, timeout)
+            except Exception as e:
+                print(f"⚠️  Full-page capture failed, falling back to scrolling folds: {e}")
+        
         screenshots = []
+        writes = []
         
         for idx in range(num_folds):
             try:
                 scroll_top = min(idx * v_height, max(total_height - v_height, 0))
-                self.page.evaluate(f"window.scrollTo(0, {scroll_top})")
-                self.page.wait_for_timeout(450)
-                filename = f"{prefix}_fold_{idx+1:02d}.png"
+                self.scroll_and_settle(0, scroll_top, 450)
+                filename = f"{prefix}_fold_{idx+1:02d}.{SCREENSHOT_EXT}"
                 path = Path(screenshot_dir) / filename
-                self.page.screenshot(path=path, full_page=False, timeout=timeout, animations="disabled", caret="hide")
+                image_bytes = self.page.screenshot(full_page=False, timeout=timeout, animations="disabled", caret="hide", **screenshot_format_options(path))
+                writes.append(screenshot_write_pool.submit(path.write_bytes, image_bytes))
                 screenshots.append({"path": str(path), "scroll_top": scroll_top})
             except Exception as e:
                 print(f"⚠️  Failed to take screenshot fold {idx+1}: {e}")
                 if not screenshots:
                     raise
         
+        # Callers read the files right away, so every write has to land before returning
+        written = []
+        for shot, write in zip(screenshots, writes):
+            try:
+                write.result()
+                written.append(shot)
+            except Exception as e:
+                print(f"⚠️  Failed to save screenshot {shot['path']}: {e}")
+        screenshots = written
+        
         try:
-            self.page.evaluate("window.scrollTo(0, 0)")
-            self.page.wait_for_timeout(250)
+            self.scroll_and_settle(0, 0, 250)
         except:
             pass
         
         if screenshots:
             return screenshots
         else:
-            screenshot_path = self.take_screenshot(Path(screenshot_dir) / f"{prefix}_fold_01.png", timeout)
+            screenshot_path = self.take_screenshot(Path(screenshot_dir) / f"{prefix}_fold_01.{SCREENSHOT_EXT}", timeout)
             return [{"path": str(screenshot_path), "scroll_top": 0}]
     
+    def crop_folds_from_full_page(self, prefix, screenshot_dir, viewport, total_height, num_folds, timeout=30000):
+        """
+        Take one full-page screenshot and cut it into viewport-sized folds with Pillow.
+        Gives the same folds and scroll_top offsets as the scroll loop without scrolling
+        the page and waiting for it to repaint at every fold.
+        """
+        v_height = viewport["height"]
+        image_bytes = self.page.screenshot(full_page=True, timeout=timeout, animations="disabled", caret="hide")
+        full_image = Image.open(io.BytesIO(image_bytes))
+        # Screenshot pixels per CSS pixel (deviceScaleFactor); the image width is the page's, not the viewport's
+        scale = self.page.evaluate("() => window.devicePixelRatio") or 1
+        right = min(round(viewport["width"] * scale), full_image.width)
+        
+        def save_fold(fold, path):
+            if SCREENSHOT_EXT == "jpg":
+                fold.convert("RGB").save(path, "JPEG", quality=JPEG_QUALITY)
+            else:
+                fold.save(path)
+        
+        screenshots = []
+        writes = []
+        for idx in range(num_folds):
+            scroll_top = min(idx * v_height, max(total_height - v_height, 0))
+            top = round(scroll_top * scale)
+            bottom = min(round((scroll_top + v_height) * scale), full_image.height)
+            fold = full_image.crop((0, top, right, bottom))
+            path = Path(screenshot_dir) / f"{prefix}_fold_{idx+1:02d}.{SCREENSHOT_EXT}"
+            # Encode the folds on the writer threads (Pillow releases the GIL while encoding)
+            writes.append(screenshot_write_pool.submit(save_fold, fold, path))
+            screenshots.append({"path": str(path), "scroll_top": scroll_top})
+        for write in writes:
+            write.result()
+        return screenshots
+    
+    def get_element_rect(self, selector):
+        """
+        Position and size of the first match ({x, y, width, height}) in one bounding_box()
+        round trip, or None if it isn't rendered. Takes a selector or an existing Locator.
+        """
+        locator = self.page.locator(selector).first if isinstance(selector, str) else selector
+        return locator.bounding_box()
+    
     def get_element_coordinates(self, selector):
-        element = self.page.locator(selector).first
-        box = element.bounding_box()
+        box = self.get_element_rect(selector)
         if box:
             return {"x": box["x"], "y": box["y"]}
         return None
     
     def get_element_size(self, selector):
-        element = self.page.locator(selector).first
-        box = element.bounding_box()
+        box = self.get_element_rect(selector)
         if box:
             return {"width": box["width"], "height": box["height"]}
         return None
@@ -698,7 +1729,14 @@ class VisionHelpers:
     def get_viewport_size(self):
         return self.page.viewport_size
     
+    def viewport(self):
+        """Viewport size of the current page (1280x720 if unknown), looked up once per page."""
+        if self._viewport is None:
+            self._viewport = self.page.viewport_size or {"width": 1280, "height": 720}
+        return self._viewport
+    
     def get_page_size(self):
+        """Scroll width/height, measured on every call: content can grow inside fixed-size boxes without any observable resize."""
         dimensions = self.page.evaluate(
             """() => ({
                 width: Math.max(
@@ -713,15 +1751,78 @@ class VisionHelpers:
         )
         return dimensions
     
-    def move_mouse(self, x, y, duration=0.35):
-        steps = max(int(duration * 30), 12)
-        self.page.mouse.move(x, y, steps=steps)
+    def get_dom_signature(self, max_elements=2000):
+        """Structural fingerprint of the page: unique parent>tag#id shingles, used for similar-page cache lookups."""
+        try:
+            return self.page.evaluate(
+                """(maxElements) => {
+                    const root = document.body || document.documentElement;
+                    if (!root) return [];
+                    const shingles = new Set();
+                    const walker = document.createTreeWalker(root, NodeFilter.SHOW_ELEMENT);
+                    let node = walker.currentNode;
+                    let count = 0;
+                    while (node && count < maxElements) {
+                        const parent = node.parentElement;
+                        let shingle = (parent ? parent.tagName : '') + '>' + node.tagName;
+                        if (node.id) shingle += '#' + node.id;
+                        if (node.tagName === 'INPUT' && node.name) shingle += '[' + node.name + ']';
+                        shingles.add(shingle);
+                        node = walker.nextNode();
+                        count++;
+                    }
+                    return Array.from(shingles);
+                }""",
+                max_elements
+            )
+        except Exception as e:
+            print(f"⚠️  Could not compute DOM signature: {e}")
+            return None
+    
+    def get_page_fingerprint(self):
+        """Cheap page-change detector: URL, visible text length, element count and typed input length."""
+        try:
+            return tuple(self.page.evaluate(
+                """() => {
+                    const body = document.body;
+                    let typed = 0;
+                    for (const field of document.querySelectorAll('input, textarea')) {
+                        typed += (field.value || '').length;
+                    }
+                    return [
+                        location.href,
+                        body ? body.innerText.length : 0,
+                        document.getElementsByTagName('*').length,
+                        typed
+                    ];
+                }"""
+            ))
+        except Exception:
+            return None
+    
+    def move_mouse_instant(self, x, y):
+        """Move the pointer straight to (x, y) with a single input event."""
+        self.page.mouse.move(x, y, steps=1)
+    
+    def move_mouse(self, x, y, duration=0.35, natural=False):
+        """
+        Move to (x, y) and click. The pointer jumps there in one event unless natural=True,
+        which interpolates a trajectory (one input event per step, ~30 per second of duration)
+        for sites that watch pointer movement.
+        """
+        if natural:
+            steps = max(int(duration * 30), 12)
+            self.page.mouse.move(x, y, steps=steps)
+        else:
+            self.move_mouse_instant(x, y)
         self.page.mouse.click(x, y)
         return True
     
     def get_window_metrics(self):
+        """Window position and sizes plus the scroll offset, in one round trip."""
         return self.page.evaluate(
             """() => ({
+                pageYOffset: window.pageYOffset,
                 screenX: window.screenX,
                 screenY: window.screenY,
                 outerWidth: window.outerWidth,
@@ -731,24 +1832,73 @@ class VisionHelpers:
             })"""
         )
     
+    def settle_frames(self, max_wait_ms=500, page=None):
+        """
+        Wait until the browser has painted two more frames (so clicks, key presses and
+        scrolls have been laid out), or max_wait_ms at most. Replaces fixed sleeps that
+        were sized for the slowest page.
+        """
+        (page or self.page).evaluate("""
+            (maxWait) => new Promise(resolve => {
+                setTimeout(resolve, maxWait);
+                requestAnimationFrame(() => requestAnimationFrame(resolve));
+            })
+        """, max_wait_ms)
+    
+    def scroll_and_settle(self, x, y, max_wait_ms=500):
+        """Jump to (x, y), wait for fonts and two painted frames (capped) and return the resulting pageYOffset."""
+        return self.page.evaluate("""
+            ([x, y, maxWait]) => new Promise(resolve => {
+                window.scrollTo({ left: x, top: y, behavior: 'instant' });
+                const done = () => resolve(window.pageYOffset);
+                setTimeout(done, maxWait);
+                document.fonts.ready.then(() => requestAnimationFrame(() => requestAnimationFrame(done)));
+            })
+        """, [x, y, max_wait_ms])
+    
     def scroll_to(self, x, y):
-        self.page.evaluate(f"window.scrollTo({x}, {y})")
-        self.page.wait_for_timeout(250)
+        self.scroll_and_settle(x, y, 250)
     
-    def viewport_to_screen(self, x, y):
-        metrics = self.get_window_metrics()
+    def viewport_to_screen(self, x, y, metrics=None):
+        # Scrolling doesn't move the window, so metrics read before a scroll still apply
+        metrics = metrics or self.get_window_metrics()
         border_x = (metrics["outerWidth"] - metrics["innerWidth"]) / 2
         border_y = metrics["outerHeight"] - metrics["innerHeight"] - border_x
         screen_x = metrics["screenX"] + border_x + x
         screen_y = metrics["screenY"] + max(border_y, 0.0) + y
         return {"screen_x": screen_x, "screen_y": screen_y}
     
+    # A tab opened by a click shows up within a few hundred ms; waiting any longer only
+    # delays same-tab clicks, which are the common case
+    NEW_TAB_WAIT_MS = 500
+    
+    def click_and_catch_new_page(self, click, wait_ms=None):
+        """
+        Run click() and return the page it opened, or None. A "page" listener records new
+        tabs while the sync API is pumped in 50ms slices, so a same-tab click returns after
+        wait_ms instead of blocking for expect_page's full timeout.
+        """
+        wait_ms = self.NEW_TAB_WAIT_MS if wait_ms is None else wait_ms
+        context = self.page.context
+        opened = []
+        record_page = opened.append
+        context.on("page", record_page)
+        try:
+            click()
+            waited = 0
+            while not opened and waited < wait_ms:
+                self.page.wait_for_timeout(50)
+                waited += 50
+        finally:
+            context.remove_listener("page", record_page)
+        return opened[0] if opened else None
+    
     def click_at_coordinates(self, x, y, scroll_into_view=True):
         """
-        Click at viewport coordinates (x, y) using pyautogui.
-        Uses two-try approach:
-        1. First try: Coordinate click WITH expect_page() to catch new tabs via events
-        2. Second try: Normal coordinate click if no new tab opened (same-tab navigation)
+        Click at viewport coordinates (x, y) with Playwright's mouse (CDP input events);
+        USE_PYAUTOGUI=1 switches back to OS-level pyautogui clicks on the X display.
+        Clicks once while watching the context for a new tab (click_and_catch_new_page):
+        switches to the tab if one opened, otherwise waits for the same-tab load.
         
         Args:
             x: X coordinate in viewport (from vision model)
@@ -759,30 +1909,43 @@ class VisionHelpers:
             dict with {"success": bool, "new_page": Page or None, "switched": bool}
         """
         try:
-            import pyautogui
+            if USE_PYAUTOGUI:
+                import pyautogui
+            
+            # Scroll offset for scroll_into_view; window position only matters for screen coordinates
+            metrics = self.get_window_metrics() if scroll_into_view or USE_PYAUTOGUI else None
             
             if scroll_into_view:
-                viewport = self.page.viewport_size or {"width": 1280, "height": 720}
-                current_scroll = self.page.evaluate("window.pageYOffset")
+                viewport = self.viewport()
+                current_scroll = metrics["pageYOffset"]
                 
                 if y < current_scroll or y > current_scroll + viewport["height"]:
                     scroll_to_y = max(0, y - viewport["height"] // 2)
-                    self.page.evaluate(f"window.scrollTo(0, {scroll_to_y})")
-                    self.page.wait_for_timeout(500)
-                    
-                    new_scroll = self.page.evaluate("window.pageYOffset")
+                    new_scroll = self.scroll_and_settle(0, scroll_to_y)
                     y = y - new_scroll
             
-            screen_coords = self.viewport_to_screen(x, y)
+            if USE_PYAUTOGUI:
+                screen_coords = self.viewport_to_screen(x, y, metrics)
+                print(f"🖱️  Clicking at viewport ({x}, {y}) → screen ({screen_coords['screen_x']:.0f}, {screen_coords['screen_y']:.0f})")
+                
+                def click():
+                    pyautogui.click(screen_coords["screen_x"], screen_coords["screen_y"])
+            else:
+                print(f"🖱️  Clicking at viewport ({x}, {y})")
+                page = self.page
+                
+                def click():
+                    page.mouse.click(x, y)
+            
+            clicked = []
             
-            print(f"🖱️  Clicking at viewport ({x}, {y}) → screen ({screen_coords['screen_x']:.0f}, {screen_coords['screen_y']:.0f})")
+            def click_once():
+                click()
+                clicked.append(True)
             
             try:
                 print(f"🔍 Attempting coordinate click with new tab detection...")
-                with self.page.context.expect_page(timeout=3000) as new_page_info:
-                    pyautogui.click(screen_coords["screen_x"], screen_coords["screen_y"])
-                
-                new_page = new_page_info.value
+                new_page = self.click_and_catch_new_page(click_once)
                 if new_page:
                     print(f"✅ New tab opened via coordinate click! Switching to: {new_page.url}")
                     try:
@@ -790,7 +1953,7 @@ class VisionHelpers:
                     except:
                         pass
                     
-                    old_url = self.page.url if not self.page.is_closed() else "unknown"
+                    old_url = page_url_or(self.page)
                     self.page = new_page
                     new_page.bring_to_front()
                     
@@ -804,11 +1967,15 @@ class VisionHelpers:
                         print(f"⚠️  Popup closing failed: {popup_error}")
                     
                     return {"success": True, "new_page": new_page, "switched": True, "popup_closed": popup_closed}
+                print(f"ℹ️  No new tab detected (same-tab navigation)")
             except Exception as expect_error:
                 print(f"ℹ️  No new tab detected (timeout or same-tab navigation): {type(expect_error).__name__}")
             
-            print(f"🖱️  Performing normal coordinate click (same-tab navigation)...")
-            pyautogui.click(screen_coords["screen_x"], screen_coords["screen_y"])
+            # The first click already landed and the listener saw no tab; a second click
+            # would hit whatever is at (x, y) while its same-tab navigation is loading
+            if not clicked:
+                print(f"🖱️  Performing normal coordinate click (same-tab navigation)...")
+                click()
             
             try:
                 self.page.wait_for_load_state('domcontentloaded', timeout=5000)
@@ -837,7 +2004,7 @@ class VisionHelpers:
         """
         try:
             if scroll_into_view:
-                viewport = self.page.viewport_size or {"width": 1280, "height": 720}
+                viewport = self.viewport()
                 viewport_height = viewport["height"]
                 
                 current_scroll = self.page.evaluate("window.pageYOffset")
@@ -845,10 +2012,7 @@ class VisionHelpers:
                 target_scroll = max(0, absolute_y - viewport_height // 2)
                 
                 if abs(current_scroll - target_scroll) > 10:
-                    self.page.evaluate(f"window.scrollTo(0, {target_scroll})")
-                    self.page.wait_for_timeout(500)
-                    
-                    new_scroll = self.page.evaluate("window.pageYOffset")
+                    new_scroll = self.scroll_and_settle(0, target_scroll)
                     y = absolute_y - new_scroll
             
             new_page = None
@@ -857,10 +2021,8 @@ class VisionHelpers:
             print(f"🖱️  Clicking at viewport coordinates ({x}, {y}) using Playwright mouse")
             
             try:
-                with self.page.context.expect_page(timeout=3000) as new_page_info:
-                    self.page.mouse.click(x, y)
-                
-                new_page = new_page_info.value
+                page = self.page
+                new_page = self.click_and_catch_new_page(lambda: page.mouse.click(x, y))
                 if new_page:
                     print(f"✅ New tab opened! Switching to: {new_page.url}")
                     try:
@@ -868,7 +2030,7 @@ class VisionHelpers:
                     except:
                         pass
                     
-                    old_url = self.page.url if not self.page.is_closed() else "unknown"
+                    old_url = page_url_or(self.page)
                     self.page = new_page
                     new_page.bring_to_front()
                     switched = True
@@ -884,13 +2046,15 @@ class VisionHelpers:
                     
                     page_to_use = new_page
                 else:
+                    print(f"ℹ️  No new tab detected (same-tab navigation)")
                     page_to_use = self.page
                     
             except Exception as expect_error:
                 print(f"ℹ️  No new tab detected (same-tab navigation): {type(expect_error).__name__}")
                 page_to_use = self.page
             
-            page_to_use.wait_for_timeout(300)
+            # Let the click's focus change land before selecting the field's contents
+            self.settle_frames(300, page_to_use)
             
             try:
                 page_to_use.keyboard.press('Control+a')
@@ -931,18 +2095,18 @@ class VisionHelpers:
             if not self.page or self.page.is_closed():
                 return None
             
-            cdp = self.page.context.new_cdp_session(self.page)
-            screenshot_data = cdp.send("Page.captureScreenshot", {"captureBeyondViewport": False})
-            
-            import base64
-            with open(path, "wb") as f:
-                f.write(base64.b64decode(screenshot_data["data"]))
+            params = {"captureBeyondViewport": False}
+            if screenshot_format_options(path):
+                params.update({"format": "jpeg", "quality": JPEG_QUALITY})
+            screenshot_data = self.cdp_session().send("Page.captureScreenshot", params)
+            Path(path).write_bytes(base64.b64decode(screenshot_data["data"]))
             
             return str(path)
         except Exception as e:
             print(f"⚠️  Window screenshot failed (trying fallback): {e}")
+            self._cdp_session = None
             try:
-                self.page.screenshot(path=path, full_page=False, timeout=timeout, animations="disabled", caret="hide")
+                self.page.screenshot(path=path, full_page=False, timeout=timeout, animations="disabled", caret="hide", **screenshot_format_options(path))
                 return str(path)
             except Exception as e2:
                 print(f"⚠️  Fallback screenshot also failed: {e2}")
@@ -953,18 +2117,9 @@ class VisionHelpers:
 # PLAYWRIGHT MANAGER CLASS
 # ============================================================================
 
-class PlaywrightManager:
-    def __init__(self, client, page=None):
-        self.client = client
-        self.page = page
-    
-    def set_page(self, page):
-        self.page = page
-    
-    def generate_script(self, instruction, context=None):
-        prompt = f"""Generate synchronous Playwright Python code based on this instruction.
-
-        Instruction: {instruction}
+# generate_script's fixed rules go in the system message and the instruction last, so every
+# request starts with the same tokens and OpenAI can serve that prefix from its prompt cache
+SCRIPT_PROMPT_RULES = """Generate synchronous Playwright Python code based on the instruction given at the end.
 
         Requirements:
         - Use SYNCHRONOUS Playwright API only (no async/await)
@@ -973,9 +2128,9 @@ class PlaywrightManager:
         - Keep code simple
         
         COORDINATE-BASED CLICKING (PRIORITIZE ON CARRIER SITES):
-        - IMPORTANT: On carrier sites, coordinate clicking with pyautogui is MORE RELIABLE than selectors
+        - IMPORTANT: On carrier sites, coordinate clicking is MORE RELIABLE than selectors
         - If instruction provides coordinates (x, y), use vision_helpers.click_at_coordinates(x, y)
-        - This uses pyautogui for OS-level clicks, avoiding Playwright selector issues
+        - This dispatches a real mouse click at those coordinates, avoiding Playwright selector issues
         - Automatically handles scrolling and coordinate conversion
         - Example: vision_helpers.click_at_coordinates(x, y)
         - More reliable than selectors for elements in overlays, modals, or complex DOMs
@@ -1001,7 +2156,10 @@ class PlaywrightManager:
           old_page = page
           link_locator = page.locator('text=EXACT_TEXT_FROM_INSTRUCTION')
           link_locator.scroll_into_view_if_needed()
-          page.wait_for_timeout(500)
+          try:
+              page.wait_for_load_state('networkidle', timeout=1500)
+          except:
+              pass
           link_locator.wait_for(state='visible', timeout=5000)
           try:
               with page.context.expect_page(timeout=10000) as new_page_info:
@@ -1062,46 +2220,89 @@ class PlaywrightManager:
         
         CARRIER SITE NAVIGATION (after reaching carrier homepage):
         - ALWAYS look for 'E-Services', 'e-Service', or 'eService' links in the top navigation
-        - AVOID generic 'Tracking' text that appears in multiple places
+        - AVOID generic 'Tracking' text that appears in multiple places"""
+
+SCRIPT_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a Playwright code generator. Output only synchronous Python code (NO async/await). No explanations or markdown.\n\n" + SCRIPT_PROMPT_RULES
+}
+
+# URL substrings that mark a new tab as an ad/tracking page without asking the vision model
+AD_URL_INDICATORS = ("ads", "advert", "marketing", "promo", "offer", "survey", "feedback", "redirect", "click", "track", "doubleclick", "googleads", "googlesyndication", "mapsplatform")
+
+# Fixed part of the tab validation prompt; the per-request context follows it (see SCRIPT_PROMPT_RULES)
+TAB_VALIDATION_RUBRIC = """Analyze this page and determine if it's related to shipping/cargo tracking.
+            
+            Look for:
+            1. Carrier logo or branding (e.g., HMM, Hyundai Merchant Marine)
+            2. Shipping/cargo tracking interface
+            3. Navigation menus for e-Services, tracking, cargo services
+            4. Shipping-related content (containers, vessels, schedules)
+            
+            This is INVALID if it shows:
+            - Generic advertisements
+            - Unrelated commercial content
+            - Survey/feedback forms
+            - Promotional offers unrelated to shipping"""
 
-        Generate code:"""
+# How long execute waits, after a script with coordinate clicks, for a tab that opens late
+NEW_TAB_SETTLE_MS = 2500
+# Cap on the network-idle wait before deciding a script left the page unchanged
+POST_EXEC_SETTLE_MS = 2000
+
+# Markdown fence the model sometimes wraps generated code in (```python ... ```)
+CODE_FENCE_PATTERN = re.compile(r"\A```(?:python)?|```\Z")
+
+@lru_cache(maxsize=256)
+def compile_script(script):
+    """Compile a generated or cached script once; compile_code checks it and execute reuses the code object."""
+    return compile(script, '<string>', 'exec')
+
+
+class PlaywrightManager:
+    def __init__(self, client, page=None):
+        self.client = client
+        self.page = page
+        # (carrier, domain) -> vision verdict, so later tabs on an already judged domain skip the model
+        self.tab_verdicts = {}
+    
+    def set_page(self, page):
+        self.page = page
+    
+    def generate_script(self, instruction, context=None, previous_error=None, previous_script=None):
+        prompt = "".join(("Instruction: ", str(instruction), "\n\nGenerate code:"))
+        if previous_error:
+            # The model only sees this prompt, so "fix that issue" needs the script it refers to
+            if previous_script:
+                prompt = "".join((prompt, "\n\nThe previous attempt was:\n", previous_script))
+            prompt = "".join((prompt, "\n\nThe previous attempt failed with: ", previous_error, ". Fix only that issue."))
 
         response = self.client.chat.completions.create(
             model="gpt-4.1-mini",
             messages=[
-                {"role": "system", "content": "You are a Playwright code generator. Output only synchronous Python code (NO async/await). No explanations or markdown."},
+                SCRIPT_SYSTEM_MESSAGE,
                 {"role": "user", "content": prompt}
             ]
         )
         
         script = response.choices[0].message.content.strip()
-        
-        if script.startswith("```python"):
-            script = script[9:]
-        if script.startswith("```"):
-            script = script[3:]
-        if script.endswith("```"):
-            script = script[:-3]
-        
-        return script.strip()
+        return CODE_FENCE_PATTERN.sub("", script).strip()
     
     def compile_code(self, code, instruction=None, context=None, max_retries=3):
+        failed_scripts = set()
         for attempt in range(max_retries):
             try:
-                compile(code, '<string>', 'exec')
+                compile_script(code)
                 return {"success": True, "code": code, "attempts": attempt + 1}
             except SyntaxError as e:
                 error_msg = f"SyntaxError at line {e.lineno}: {str(e)}"
-                if attempt < max_retries - 1 and instruction:
-                    code = self.generate_script(instruction, context)
-                else:
-                    return {"success": False, "error": error_msg, "attempts": attempt + 1}
             except Exception as e:
                 error_msg = str(e)
-                if attempt < max_retries - 1 and instruction:
-                    code = self.generate_script(instruction, context)
-                else:
-                    return {"success": False, "error": error_msg, "attempts": attempt + 1}
+            # The model regenerating a script that already failed means it won't fix it; stop paying for retries
+            if code in failed_scripts or attempt >= max_retries - 1 or not instruction:
+                return {"success": False, "error": error_msg, "attempts": attempt + 1}
+            failed_scripts.add(code)
+            code = self.generate_script(instruction, context, previous_error=error_msg, previous_script=code)
         
         return {"success": False, "error": "Max retries reached", "attempts": max_retries}
     
@@ -1110,122 +2311,179 @@ class PlaywrightManager:
         Validate if a newly opened tab is legitimate using context + vision.
         Returns True if tab should be switched to, False if it should be closed.
         """
+        return self.start_tab_validation(new_page, context, milestone).result()
+    
+    def start_tab_validation(self, new_page, context, milestone):
+        """
+        validate_new_tab without blocking on the answer: URL checks and the screenshot run here,
+        the vision call on llm_pool. Returns a Future resolving to True/False.
+        """
         try:
-            new_url = new_page.url
-            prev_url = context.current_url
-            carrier = context.carrier
-            
-            def get_domain(url):
-                from urllib.parse import urlparse
-                try:
-                    return urlparse(url).netloc.lower()
-                except:
-                    return url.lower()
+            url_decision = self.tab_url_decision(new_page, context)
+            if url_decision is not None:
+                return resolved_future(url_decision)
             
-            new_domain = get_domain(new_url)
-            prev_domain = get_domain(prev_url)
+            print(f"⚠️  URL check inconclusive, using vision validation...")
             
-            print(f"🔍 Validating new tab: {new_domain}")
+            try:
+                screenshot = self.tab_validation_screenshot(new_page)
+            except Exception as screenshot_error:
+                print(f"⚠️  Vision validation failed: {screenshot_error}, allowing tab by default")
+                return resolved_future(True)
             
-            ad_indicators = ["ads", "advert", "marketing", "promo", "offer", "survey", "feedback", "redirect", "click", "track", "doubleclick", "googleads", "googlesyndication", "mapsplatform"]
-            is_ad_page = any(indicator in new_url.lower() for indicator in ad_indicators)
+            domain = url_domain(new_page.url)
+            return llm_pool.submit(lambda: self.vision_validate_tabs([screenshot], context.carrier, milestone, [domain])[0])
+                
+        except Exception as e:
+            print(f"⚠️  Tab validation error: {e}, allowing tab by default")
+            return resolved_future(True)
+    
+    def validate_new_tabs(self, pages, context, milestone):
+        """
+        validate_new_tab for several tabs at once: tabs the URL checks can't decide go to the
+        vision model together in one request. Returns one True/False per page, in order.
+        """
+        results = [True] * len(pages)
+        pending = []
+        for index, new_page in enumerate(pages):
+            try:
+                url_decision = self.tab_url_decision(new_page, context)
+                if url_decision is not None:
+                    results[index] = url_decision
+                    continue
+                print(f"⚠️  URL check inconclusive, using vision validation...")
+                pending.append((index, url_domain(new_page.url), self.tab_validation_screenshot(new_page)))
+            except Exception as e:
+                print(f"⚠️  Tab validation error: {e}, allowing tab by default")
+        
+        if pending:
+            answers = self.vision_validate_tabs(
+                [screenshot for _, _, screenshot in pending], context.carrier, milestone,
+                [domain for _, domain, _ in pending]
+            )
+            for (index, _, _), is_valid in zip(pending, answers):
+                results[index] = is_valid
+        return results
+    
+    def tab_url_decision(self, new_page, context):
+        """URL-only verdict on a new tab: True/False when the URL settles it, None when vision is needed."""
+        new_url = new_page.url
+        new_url_lower = new_url.lower()
+        prev_url = context.current_url
+        carrier = context.carrier  # set_goal stores it lowercased
+        
+        new_domain = url_domain(new_url)
+        prev_domain = url_domain(prev_url)
+        
+        print(f"🔍 Validating new tab: {new_domain}")
+        
+        is_ad_page = any(indicator in new_url_lower for indicator in AD_URL_INDICATORS)
+        
+        if is_ad_page:
+            print(f"❌ Ad page detected: {new_domain}")
+            return False
+        
+        if new_domain == prev_domain:
+            print(f"✅ Same domain as previous page")
+            return True
+        
+        if carrier and carrier in new_url_lower:
+            print(f"✅ URL contains carrier name: {carrier}")
+            return True
+        
+        known_verdict = self.tab_verdicts.get((carrier, new_domain))
+        if known_verdict is not None:
+            print(f"{'✅' if known_verdict else '❌'} Domain already validated by vision: {new_domain}")
+        return known_verdict
+    
+    def tab_validation_screenshot(self, new_page):
+        # Viewport only, and a short timeout: a tab that can't render in 5s is allowed by default anyway
+        return new_page.screenshot(full_page=False, timeout=5000, animations="disabled", caret="hide", type="jpeg", quality=JPEG_QUALITY)
+    
+    def vision_validate_tabs(self, screenshots, carrier, milestone, domains=()):
+        """
+        Ask the vision model whether each tab screenshot belongs to the carrier; one True/False per screenshot.
+        Answers are remembered per (carrier, domain) for the matching entry of domains.
+        """
+        try:
+            if len(screenshots) == 1:
+                answer_format = """Answer with ONLY 'yes' or 'no':"""
+            else:
+                answer_format = f"""There are {len(screenshots)} screenshots, one per tab, labelled Tab 1 to Tab {len(screenshots)}.
+            Answer with ONLY a comma-separated list of 'yes' or 'no', one per tab in order (e.g. yes, no):"""
             
-            if is_ad_page:
-                print(f"❌ Ad page detected: {new_domain}")
-                return False
+            vision_prompt = f"""{TAB_VALIDATION_RUBRIC}
             
-            url_valid = False
+            Context:
+            - Carrier: {carrier.upper() if carrier else 'Unknown'}
+            - Current milestone: {milestone}
+            - Expected: Should show carrier branding, shipping services, or tracking interface
             
-            if new_domain == prev_domain:
-                url_valid = True
-                print(f"✅ Same domain as previous page")
+            {answer_format}
+            - yes = This page is related to the carrier or shipping tracking
+            - no = This is an ad/unrelated page
+            """
             
-            elif carrier and carrier.lower() in new_url.lower():
-                url_valid = True
-                print(f"✅ URL contains carrier name: {carrier}")
+            content = [{"type": "text", "text": vision_prompt}]
+            for index, screenshot in enumerate(screenshots, 1):
+                if len(screenshots) > 1:
+                    content.append({"type": "text", "text": f"Tab {index}:"})
+                content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_data_url(screenshot),
+                        # A yes/no on branding doesn't need detail; low caps the image at 512px and a few dozen tokens
+                        "detail": "low"
+                    }
+                })
             
-            if url_valid:
-                return True
+            response = self.client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": content}],
+                max_tokens=10 if len(screenshots) == 1 else 4 * len(screenshots)
+            )
             
-            print(f"⚠️  URL check inconclusive, using vision validation...")
+            answer = response.choices[0].message.content.strip().lower()
+            if len(screenshots) == 1:
+                verdicts = ["yes" in answer]
+            else:
+                verdicts = [word == "yes" for word in re.findall(r"\b(yes|no)\b", answer)][:len(screenshots)]
+            for domain, is_valid in zip(domains, verdicts):
+                self.tab_verdicts[(carrier, domain)] = is_valid
+            # Tabs the model didn't answer for are allowed (and not remembered), as when the call fails
+            verdicts += [True] * (len(screenshots) - len(verdicts))
             
-            try:
-                screenshot = new_page.screenshot(timeout=30000, animations="disabled", caret="hide")
-                screenshot_path = f"temp_tab_validation_{int(time.time())}.png"
-                new_page.screenshot(path=screenshot_path, timeout=30000, animations="disabled", caret="hide")
-                
-                vision_prompt = f"""Analyze this page and determine if it's related to shipping/cargo tracking.
-                
-                Context:
-                - Carrier: {carrier.upper() if carrier else 'Unknown'}
-                - Current milestone: {milestone}
-                - Expected: Should show carrier branding, shipping services, or tracking interface
-                
-                Look for:
-                1. Carrier logo or branding (e.g., HMM, Hyundai Merchant Marine)
-                2. Shipping/cargo tracking interface
-                3. Navigation menus for e-Services, tracking, cargo services
-                4. Shipping-related content (containers, vessels, schedules)
-                
-                This is INVALID if it shows:
-                - Generic advertisements
-                - Unrelated commercial content
-                - Survey/feedback forms
-                - Promotional offers unrelated to shipping
-                
-                Answer with ONLY 'yes' or 'no':
-                - yes = This page is related to the carrier or shipping tracking
-                - no = This is an ad/unrelated page
-                """
-                
-                response = self.client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": vision_prompt},
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/png;base64,{base64.b64encode(screenshot).decode()}"
-                                    }
-                                }
-                            ]
-                        }
-                    ],
-                    max_tokens=10
-                )
-                
-                import os
-                if os.path.exists(screenshot_path):
-                    os.remove(screenshot_path)
-                
-                answer = response.choices[0].message.content.strip().lower()
-                is_valid = "yes" in answer
-                
+            for is_valid in verdicts:
                 if is_valid:
                     print(f"✅ Vision confirmed: Tab is legitimate")
                 else:
                     print(f"❌ Vision confirmed: Tab is ad/unrelated")
-                
-                return is_valid
-                
-            except Exception as vision_error:
-                print(f"⚠️  Vision validation failed: {vision_error}, allowing tab by default")
-                return True
-                
-        except Exception as e:
-            print(f"⚠️  Tab validation error: {e}, allowing tab by default")
-            return True
+            
+            return verdicts
+            
+        except Exception as vision_error:
+            print(f"⚠️  Vision validation failed: {vision_error}, allowing tab by default")
+            return [True] * len(screenshots)
+    
+    def hand_over_tab(self, vision_helpers, tab):
+        """Point vision_helpers at a tab being switched to and clear its popups (unless a click already did)."""
+        vision_helpers.page = tab
+        if not vision_helpers.popup_closed_by_click:
+            try:
+                vision_helpers.close_popup()
+            except Exception as popup_error:
+                print(f"⚠️  Popup closing failed: {popup_error}")
+        else:
+            print(f"ℹ️  Popups already closed by click_at_coordinates(), skipping duplicate close")
     
     def execute(self, script, vision_helpers=None, context=None, milestone=None):
         if not self.page:
             return {"success": False, "error": "No page object available"}
+        url_before = "unknown"
         try:
             tabs_before = len(self.page.context.pages)
             try:
-                url_before = self.page.url if not self.page.is_closed() else "unknown"
+                url_before = page_url_or(self.page)
             except:
                 url_before = "unknown"
             
@@ -1238,7 +2496,18 @@ class PlaywrightManager:
                 local_vars["vision_helpers"] = vision_helpers
             if context and hasattr(context, 'booking_id') and context.booking_id:
                 local_vars["booking_id"] = context.booking_id
-            exec(script, {}, local_vars)
+            
+            # Tabs the script opens are recorded as they arrive, so the wait below only happens
+            # when one might still be on its way
+            browser_context = self.page.context
+            opened_pages = []
+            on_page = opened_pages.append
+            browser_context.on("page", on_page)
+            try:
+                exec(compile_script(script), {}, local_vars)
+            except Exception:
+                browser_context.remove_listener("page", on_page)
+                raise
             result = local_vars.get("result")
             if not isinstance(result, dict):
                 result = {}
@@ -1254,12 +2523,27 @@ class PlaywrightManager:
                     new_page = vision_helpers.page
                     script_switched = True
             
-            if "click_at_coordinates" in script:
-                wait_time = 2.5
-            else:
-                wait_time = 1.5
+            uses_click_coords = "click_at_coordinates" in script
+            
+            # Start validating the tab the script switched to now, so the vision call (if the URL
+            # checks are inconclusive) runs during the new-tab wait instead of after it
+            script_tab_validation = None
+            if script_switched and context and milestone:
+                try:
+                    new_page.wait_for_load_state('domcontentloaded', timeout=5000)
+                except:
+                    pass
+                script_tab_validation = self.start_tab_validation(new_page, context, milestone)
             
-            time.sleep(wait_time)
+            # A coordinate click can open a tab a moment after it returns; anything else that opens
+            # tabs (expect_page in the script) has them by now. wait_for_event also pumps Playwright's
+            # event loop, which a plain sleep did not, so late tabs actually show up in context.pages.
+            if uses_click_coords and not opened_pages:
+                try:
+                    browser_context.wait_for_event("page", timeout=NEW_TAB_SETTLE_MS)
+                except PlaywrightTimeoutError:
+                    pass
+            browser_context.remove_listener("page", on_page)
             
             tabs_after = len(self.page.context.pages)
             auto_switched = False
@@ -1272,34 +2556,28 @@ class PlaywrightManager:
                 new_tabs = all_pages[tabs_before:]
                 
                 if script_switched and new_page in new_tabs:
-                    try:
-                        new_page.wait_for_load_state('domcontentloaded', timeout=5000)
-                    except:
-                        pass
-                    
-                    if context and milestone:
-                        script_tab_valid = self.validate_new_tab(new_page, context, milestone)
+                    if script_tab_validation:
+                        script_tab_valid = script_tab_validation.result()
                         if not script_tab_valid:
                             print(f"⚠️  Script switched to tab, but validation failed: {new_page.url}")
                     else:
                         script_tab_valid = True
                 
                 if not script_switched or not script_tab_valid:
-                    for new_tab in new_tabs:
-                        if script_switched and new_tab == new_page and not script_tab_valid:
-                            continue
-                        
+                    candidate_tabs = [new_tab for new_tab in new_tabs if not (script_switched and new_tab == new_page)]
+                    for new_tab in candidate_tabs:
                         try:
                             new_tab.wait_for_load_state('domcontentloaded', timeout=5000)
                         except:
                             pass
-                        
-                        if context and milestone:
-                            is_valid = self.validate_new_tab(new_tab, context, milestone)
-                        else:
-                            print(f"⚠️  No context for validation, accepting tab")
-                            is_valid = True
-                        
+                    
+                    if context and milestone:
+                        tab_verdicts = self.validate_new_tabs(candidate_tabs, context, milestone)
+                    else:
+                        print(f"⚠️  No context for validation, accepting tab")
+                        tab_verdicts = [True] * len(candidate_tabs)
+                    
+                    for new_tab, is_valid in zip(candidate_tabs, tab_verdicts):
                         if is_valid:
                             print(f"✅ Switching to validated new tab: {new_tab.url}")
                             new_tab.bring_to_front()
@@ -1307,14 +2585,7 @@ class PlaywrightManager:
                             auto_switched = True
                             
                             if vision_helpers:
-                                vision_helpers.page = new_tab
-                                if not vision_helpers.popup_closed_by_click:
-                                    try:
-                                        vision_helpers.close_popup()
-                                    except Exception as popup_error:
-                                        print(f"⚠️  Popup closing failed: {popup_error}")
-                                else:
-                                    print(f"ℹ️  Popups already closed by click_at_coordinates(), skipping duplicate close")
+                                self.hand_over_tab(vision_helpers, new_tab)
                             
                             break
                         else:
@@ -1327,24 +2598,17 @@ class PlaywrightManager:
                     print(f"✅ Script switched to valid tab: {new_page.url}")
                     
                     if vision_helpers:
-                        vision_helpers.page = new_page
-                        if not vision_helpers.popup_closed_by_click:
-                            try:
-                                vision_helpers.close_popup()
-                            except Exception as popup_error:
-                                print(f"⚠️  Popup closing failed: {popup_error}")
-                        else:
-                            print(f"ℹ️  Popups already closed by click_at_coordinates(), skipping duplicate close")
+                        self.hand_over_tab(vision_helpers, new_page)
                     
                     auto_switched = True
             
             elif script_switched:
-                if context and milestone:
+                if script_tab_validation:
                     try:
-                        script_tab_valid = self.validate_new_tab(new_page, context, milestone)
+                        script_tab_valid = script_tab_validation.result()
                         if not script_tab_valid:
                             print(f"⚠️  Script switched to tab, but validation failed: {new_page.url}")
-                            current_url = new_page.url if not new_page.is_closed() else "unknown"
+                            current_url = page_url_or(new_page)
                             print(f"⚠️  Current tab URL: {current_url}")
                     except Exception as e:
                         print(f"⚠️  Error validating script's tab: {e}")
@@ -1356,7 +2620,7 @@ class PlaywrightManager:
                     auto_switched = True
             
             try:
-                url_after = self.page.url if not self.page.is_closed() else "unknown"
+                url_after = page_url_or(self.page)
                 if url_after != "unknown" and url_after != url_before and tabs_after == tabs_before and not script_switched:
                     print(f"🔄 Same-tab navigation detected: {url_before} → {url_after}")
             except:
@@ -1367,11 +2631,12 @@ class PlaywrightManager:
             return_dict = {
                 "success": True, 
                 "result": result,
-                "switched_to_new_page": switched_to_new_page
+                "switched_to_new_page": switched_to_new_page,
+                "url_before": url_before
             }
             
             popup_already_closed_by_click = False
-            if "click_at_coordinates" in script and switched_to_new_page:
+            if uses_click_coords and switched_to_new_page:
                 popup_already_closed_by_click = True
             
             return_dict["popup_already_closed"] = popup_already_closed_by_click
@@ -1382,13 +2647,43 @@ class PlaywrightManager:
             return return_dict
         except Exception as e:
             error_str = str(e) if e else repr(e)
-            return {"success": False, "error": error_str, "error_type": type(e).__name__}
+            return {"success": False, "error": error_str, "error_type": type(e).__name__, "url_before": url_before}
 
 
 # ============================================================================
 # LOGGER CLASS
 # ============================================================================
 
+def read_tail_lines(path, count, chunk_size=8192):
+    """Last `count` non-empty lines of a file, reading backwards in chunks instead of the whole file."""
+    with open(path, "rb") as f:
+        position = f.seek(0, os.SEEK_END)
+        data = b""
+        while position > 0 and data.count(b"\n") <= count:
+            read_size = min(chunk_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+    pieces = data.split(b"\n")
+    if position > 0:
+        # First piece may be the tail of an earlier line; it is empty when the chunk
+        # starts right after a newline, so drop it before filtering out blank lines
+        pieces = pieces[1:]
+    lines = [line for line in pieces if line.strip()]
+    return lines[-count:] if count > 0 else []
+
+def log_json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def dumps_log_line(entry):
+    """Serialize a log entry to one JSONL line as bytes (orjson when installed; datetimes become ISO strings)"""
+    if orjson is not None:
+        return orjson.dumps(entry, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(entry, default=log_json_default) + "\n").encode("utf-8")
+
+
 class Logger:
     def __init__(self, log_dir, run_id=None):
         self.log_dir = Path(log_dir)
@@ -1400,10 +2695,17 @@ class Logger:
         self.step_start_time = None
         self.step_operations = []
         self.step_errors = []
+        # Serialized complete.jsonl lines, written in one append per step instead of per operation
+        self.pending_lines = []
+        # Writes go through a queue to a daemon thread that keeps both files open for the run,
+        # so the agent loop never waits on disk; close() drains the queue and closes the files
+        self.write_queue = queue.Queue()
+        self.writer_thread = threading.Thread(target=self._writer, name="log-writer", daemon=True)
+        self.writer_thread.start()
     
     def log_operation(self, operation_type, data=None, success=True, duration_ms=None):
         entry = {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": datetime.now(),
             "run_id": self.run_id,
             "step": self.current_step,
             "operation_type": operation_type,
@@ -1413,13 +2715,47 @@ class Logger:
         if duration_ms:
             entry["duration_ms"] = duration_ms
         
-        with open(self.complete_log_path, "a") as f:
-            f.write(json.dumps(entry) + "\n")
+        self.pending_lines.append(dumps_log_line(entry))
         
         self.step_operations.append(operation_type)
         if not success:
             self.step_errors.append({"operation": operation_type, "data": data})
     
+    def _writer(self):
+        log_files = {}
+        try:
+            while True:
+                item = self.write_queue.get()
+                try:
+                    if item is None:
+                        return
+                    path, data = item
+                    if path not in log_files:
+                        log_files[path] = open(path, "ab")
+                    log_files[path].write(data)
+                    log_files[path].flush()
+                except Exception as e:
+                    print(f"⚠️  Failed to write log file: {e}")
+                finally:
+                    self.write_queue.task_done()
+        finally:
+            for log_file in log_files.values():
+                log_file.close()
+    
+    def flush(self):
+        """Hand the buffered operations to the writer thread."""
+        if not self.pending_lines:
+            return
+        self.write_queue.put((self.complete_log_path, b"".join(self.pending_lines)))
+        self.pending_lines = []
+    
+    def close(self):
+        """Write out everything logged so far and close the log files."""
+        self.flush()
+        if self.writer_thread.is_alive():
+            self.write_queue.put(None)
+            self.writer_thread.join()
+    
     def start_step(self):
         self.current_step += 1
         self.step_start_time = time.time()
@@ -1441,41 +2777,26 @@ class Logger:
             "duration_ms": duration_ms
         }
         
-        with open(self.pipeline_log_path, "a") as f:
-            f.write(json.dumps(pipeline_entry) + "\n")
+        self.flush()
+        self.write_queue.put((self.pipeline_log_path, dumps_log_line(pipeline_entry)))
         
         return pipeline_entry
     
     def get_recent_pipeline_logs(self, count=6):
+        self.write_queue.join()  # queued pipeline lines must be on disk before reading the tail
         if not self.pipeline_log_path.exists():
             return []
         
-        with open(self.pipeline_log_path, "r") as f:
-            lines = f.readlines()
-        
-        recent_lines = lines[-count:] if len(lines) > count else lines
-        return [json.loads(line) for line in recent_lines]
+        return [json.loads(line) for line in read_tail_lines(self.pipeline_log_path, count)]
 
 
 # ============================================================================
 # AGENT FUNCTIONS
 # ============================================================================
 
-def reasoning_agent(client, context):
-    carrier = context.get("carrier", "unknown")
-    current_url = context.get("current_url", "unknown")
-    last_milestone = context.get("last_achieved_milestone", "None")
-    next_milestone = context.get("next_milestone", "Unknown")
-    remaining_count = len(context.get("remaining_milestones", []))
-    
-    system_prompt = f"""You are the COMMANDER. You analyze the automation state and decide what needs to happen next.
-
-    CURRENT STATE:
-    - Target Carrier: {carrier.upper()}
-    - Current URL: {current_url}
-    - Last Achieved Milestone: {last_milestone}
-    - FOCUS → Next Milestone: {next_milestone}
-    - Remaining Milestones: {remaining_count}
+# Static instructions only, so the system messages are a byte-identical prefix across
+# steps and OpenAI's prompt cache applies; per-step state goes in the user message
+REASONING_AGENT_SYSTEM_PROMPT = """You are the COMMANDER. You analyze the automation state (CURRENT STATE and context in the user message) and decide what needs to happen next.
 
     YOUR JOB:
     1. Check if goal is achieved (voyage number and arrival date extracted)
@@ -1493,7 +2814,7 @@ def reasoning_agent(client, context):
     - Once next_milestone is achieved, the system will automatically move to the following milestone
 
     KEY RULES:
-    - Use context.carrier to identify which carrier to look for (currently: {carrier})
+    - Use context.carrier to identify which carrier to look for (also given under CURRENT STATE)
     - ALWAYS use context.current_url (the deterministic URL from the browser) - DO NOT infer or guess URLs from screenshots or other context
     - If context.current_url doesn't match expected page → navigation is needed
     - Look for "E-Services", "e-Service", "eService", or "Online Services" navigation items on carrier sites BEFORE looking for input fields
@@ -1533,7 +2854,7 @@ def reasoning_agent(client, context):
     COORDINATE CLICKING PRIORITY:
     - On CARRIER SITES (not aggregator): Prioritize coordinate clicking over selectors when vision provides coordinates
     - On AGGREGATOR SITES: Use selectors first, coordinates as fallback
-    - Coordinate clicking with pyautogui is MORE RELIABLE on carrier sites (avoids overlays, modals, strict mode)
+    - Coordinate clicking is MORE RELIABLE on carrier sites (avoids overlays, modals, strict mode)
     - Example instruction: "Vision found input at (x, y). Use vision_helpers.click_at_coordinates(x, y)"
 
     HANDLING "Found booking ID input field, entered booking ID, and submitted tracking query" MILESTONE:
@@ -1573,7 +2894,7 @@ def reasoning_agent(client, context):
     CRITICAL URL RESTRICTIONS - NEVER VIOLATE THESE:
     - NEVER EVER instruct direct navigation to carrier sites
     - NEVER suggest page.goto() with any carrier domain URLs in your language_instruction
-    - To reach carrier site: ALWAYS instruct to "find and click the {carrier} carrier link on the aggregator site"
+    - To reach carrier site: ALWAYS instruct to "find and click the target carrier's link on the aggregator site"
     - Only allow page.goto() for known aggregator sites (e.g., "navigate to seacargotracking.net" is OK)
 
     HANDLING "Data extracted" MILESTONE:
@@ -1586,61 +2907,62 @@ def reasoning_agent(client, context):
       * The system will check all folds sequentially until both fields are found with high confidence
       * For arrival date, ensure it is the date at the FINAL DESTINATION port, not intermediate ports
 
-    CRITICAL REMINDER:
-    Your ONLY job this step is: "{next_milestone}"
-    Do NOT try to accomplish multiple milestones at once.
-
-    OUTPUT FORMAT:
-    {{
+    OUTPUT FORMAT (respond with a single JSON object):
+    {
     "goal_achieved": boolean,
     "next_milestone": "copy from context.next_milestone - what you're focusing on completing in this step",
     "vision_objective": "what vision should look for (specific to next_milestone only)",
     "language_instruction": "what action to take (specific to next_milestone only - be explicit and focused)",
     "reasoning": "why this step completes next_milestone",
     "failure_analysis": "if failures are detected in history, explain how to avoid repetition",
-    "ad_recovery": {{
+    "ad_recovery": {
         "detected": boolean (true if ad page detected),
         "recovery_url": "URL to navigate back to (from history)",
         "reset_to_milestone": "milestone name to reset to based on recovery URL"
-    }} (only include if ad page detected, otherwise omit this field)
-    }}"""
+    } (only include if ad page detected, otherwise omit this field)
+    }"""
+
+
+def reasoning_agent(client, context):
+    carrier = context.get("carrier", "unknown")
+    current_url = context.get("current_url", "unknown")
+    last_milestone = context.get("last_achieved_milestone", "None")
+    next_milestone = context.get("next_milestone", "Unknown")
+    remaining_count = len(context.get("remaining_milestones", []))
     
-    prompt = f"""Current Context:
-            {json.dumps(context, indent=2)}
+    
+    prompt = f"""CURRENT STATE:
+            - Target Carrier: {carrier.upper()}
+            - Current URL: {current_url}
+            - Last Achieved Milestone: {last_milestone}
+            - FOCUS → Next Milestone: {next_milestone}
+            - Remaining Milestones: {remaining_count}
+
+            CRITICAL REMINDER:
+            Your ONLY job this step is: "{next_milestone}"
+            Do NOT try to accomplish multiple milestones at once.
+
+            Current Context:
+            {serialize_context(context)}
             Analyze the context and decide the next step."""
 
     response = client.chat.completions.create(
         model="gpt-4.1-mini",
         messages=[
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": SHARED_KNOWLEDGE_PROMPT},
+            {"role": "system", "content": REASONING_AGENT_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
-        ]
+        ],
+        response_format={"type": "json_object"}
     )
     
     result = response.choices[0].message.content.strip()
     
-    start = result.find("{")
-    end = result.rfind("}") + 1
-    if start != -1 and end > start:
-        result = result[start:end]
-    
     return json.loads(result)
 
 
-def vision_agent(client, screenshot_path, objective):
-    with open(screenshot_path, "rb") as f:
-        image_data = base64.b64encode(f.read()).decode("utf-8")
-    
-    is_input_field_analysis = any(keyword in objective.lower() for keyword in [
-        "input field", "text input", "booking id input", "b/l input", "container input",
-        "enter booking", "enter the id", "input for booking"
-    ])
-    
-    if is_input_field_analysis:
-        system_prompt = f"""You are a vision analysis agent specialized in analyzing input fields and their submission mechanisms.
-
-    CURRENT OBJECTIVE:
-    {objective}
+# The objective is sent in the user message, so these stay static (see REASONING_AGENT_SYSTEM_PROMPT)
+VISION_INPUT_FIELD_SYSTEM_PROMPT = """You are a vision analysis agent specialized in analyzing input fields and their submission mechanisms.
 
     CRITICAL REQUIREMENTS - READ CAREFULLY:
     - You MUST identify ACTUAL TEXT INPUT FIELDS (rectangular boxes where users type text)
@@ -1681,49 +3003,46 @@ def vision_agent(client, screenshot_path, objective):
     - Inputs in unrelated sections (contact forms, etc.) → lower relevance
     - ONLY score actual input fields - exclude buttons and other elements from scoring
 
-    OUTPUT FORMAT (use this EXACT structure):
-    {{
+    OUTPUT FORMAT (a single JSON object with this EXACT structure):
+    {
     "found": boolean,
     "input_groups": [
-        {{
-            "input": {{
+        {
+            "input": {
                 "label": "descriptive label of input field (MUST be an actual input box, NOT a button)",
                 "x": x_coordinate,
                 "y": y_coordinate,
                 "confidence": 0.0-1.0
-            }},
-            "submission": {{
+            },
+            "submission": {
                 "method": "enter_key" | "button_click",
-                "button": {{
+                "button": {
                     "label": "button text/label",
                     "x": x_coordinate,
                     "y": y_coordinate,
                     "confidence": 0.0-1.0
-                }} | null,
+                } | null,
                 "button_distance": distance_in_pixels | null,
                 "reasoning": "explanation of why this submission method was chosen. NOTE: Always prefer 'enter_key' as the default - it works on most forms. Only use 'button_click' if Enter key is explicitly known to not work."
-            }},
+            },
             "relevance_score": 0.0-1.0,
             "relevance_reasoning": "why this input is relevant for booking ID entry"
-        }}
+        }
     ],
-    "elements": [{{"label": "name", "x": coord, "y": coord, "confidence": 0.0-1.0}}],  // Keep for backward compatibility
+    "elements": [{"label": "name", "x": coord, "y": coord, "confidence": 0.0-1.0}],  // Keep for backward compatibility
     "notes": "overall observations about input fields and submission mechanisms found"
-    }}
+    }
     
     VALIDATION CHECKLIST BEFORE RETURNING:
     - For each input_group: Verify the "input" element is actually a rectangular text input box (not a button)
     - Double-check coordinates point to an input field (white/gray box with border), not a button (colored element)
     - If unsure whether something is an input or button, do NOT include it - only return elements you're CERTAIN are input fields
-    - If you find 0 input fields, return {{"found": false, "input_groups": [], "notes": "No text input fields found for booking ID entry"}}"""
-    else:
-        system_prompt = f"""You are a vision analysis agent. You analyze screenshots to understand page state and locate elements.
+    - If you find 0 input fields, return {"found": false, "input_groups": [], "notes": "No text input fields found for booking ID entry"}"""
 
-    CURRENT OBJECTIVE:
-    {objective}
+VISION_AGENT_SYSTEM_PROMPT = """You are a vision analysis agent. You analyze screenshots to understand page state and locate elements.
 
     YOUR JOB:
-    - Analyze screenshots based on the objective above
+    - Analyze screenshots based on the objective in the user message
     - Look for the SPECIFIC element/pattern described in the objective ONLY
     - DO NOT return random/unrelated elements (cookie popups, navigation links, etc.) unless explicitly asked for them
     - If objective asks for a carrier link → return ONLY carrier links matching that name, ignore everything else
@@ -1743,12 +3062,26 @@ def vision_agent(client, screenshot_path, objective):
     - You analyze AFTER script execution (you inform what changed and current state)
     - Your analysis guides both the language agent (what actions are possible) and the reasoning agent (what happened)
 
-    OUTPUT:
-    {{
+    OUTPUT (a single JSON object):
+    {
     "found": boolean,
-    "elements": [{{"label": "name", "x": coord, "y": coord, "confidence": 0.0-1.0}}],
+    "elements": [{"label": "name", "x": coord, "y": coord, "confidence": 0.0-1.0}],
     "notes": "observations about the page state, what changed, what's visible, any errors"
-    }}"""
+    }"""
+
+
+def vision_agent(client, screenshot_path, objective):
+    image_url = screenshot_data_url(screenshot_path)
+    
+    is_input_field_analysis = any(keyword in objective.lower() for keyword in [
+        "input field", "text input", "booking id input", "b/l input", "container input",
+        "enter booking", "enter the id", "input for booking"
+    ])
+    
+    if is_input_field_analysis:
+        system_prompt = VISION_INPUT_FIELD_SYSTEM_PROMPT
+    else:
+        system_prompt = VISION_AGENT_SYSTEM_PROMPT
     
     prompt = f"""Objective: {objective}
             Analyze this screenshot and locate the elements."""
@@ -1761,19 +3094,15 @@ def vision_agent(client, screenshot_path, objective):
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": [
                 {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_data}"}}
+                {"type": "image_url", "image_url": {"url": image_url}}
             ]}
         ],
-        temperature=0.0  # Lower temperature for more deterministic results
+        temperature=0.0,  # Lower temperature for more deterministic results
+        response_format={"type": "json_object"}
     )
     
     result = response.choices[0].message.content.strip()
     
-    start = result.find("{")
-    end = result.rfind("}") + 1
-    if start != -1 and end > start:
-        result = result[start:end]
-    
     vision_result = json.loads(result)
     
     if is_input_field_analysis and vision_result.get("input_groups"):
@@ -1782,6 +3111,20 @@ def vision_agent(client, screenshot_path, objective):
     return vision_result
 
 
+def submit_vision_queries(client, screenshots, objective):
+    """
+    Dispatch vision analysis for every screenshot at once on the LLM pool.
+    Returns futures in screenshot order so callers keep fold-order semantics
+    and can stop early, cancelling whatever has not started yet.
+    """
+    return [llm_pool.submit(vision_agent, client, screenshot["path"], objective) for screenshot in screenshots]
+
+
+def cancel_pending(futures):
+    for future in futures:
+        future.cancel()
+
+
 def adjust_vision_coordinates_for_scroll(vision_result, scroll_top):
     """
     Adjust vision result coordinates by adding scroll_top offset to y coordinates.
@@ -1866,16 +3209,27 @@ def validate_input_fields_from_vision(vision_result, screenshot_path=None):
     return vision_result
 
 
-def validate_input_fields_against_dom(page, vision_result):
+def validate_input_fields_against_dom(page, vision_result, probe_cache=None):
     """
     Use Playwright to verify that coordinates from vision actually point to input fields.
     This is called after vision returns results, when we have page access.
     Improved to account for scroll position and provide fallback for high-confidence vision results.
+    probe_cache (the run's context.input_probes) keeps confirmed hits so retries of the same
+    milestone skip the elementFromPoint scan; only hits are kept, since a popup closing can
+    turn a miss into a hit.
     """
     if not vision_result.get("input_groups"):
         return vision_result
     
     validated_groups = []
+    probe_prefix = None
+    if probe_cache is not None:
+        try:
+            # The same viewport point hits a different element once the page scrolls
+            scroll_x, scroll_y = page.evaluate("() => [window.scrollX, window.scrollY]")
+            probe_prefix = (page.url, scroll_x, scroll_y)
+        except Exception as scroll_error:
+            print(f"⚠️  Could not read scroll offset, skipping probe cache: {scroll_error}")
     
     for group in vision_result.get("input_groups", []):
         input_info = group.get("input", {})
@@ -1885,62 +3239,63 @@ def validate_input_fields_against_dom(page, vision_result):
         relevance_score = group.get("relevance_score", 0.0)
         
         try:
-            scroll_info = page.evaluate("""() => ({
-                scrollX: window.pageXOffset || window.scrollX || 0,
-                scrollY: window.pageYOffset || window.scrollY || 0,
-                viewportWidth: window.innerWidth,
-                viewportHeight: window.innerHeight
-            })""")
-            
-            element_info = page.evaluate(f"""
-                () => {{
-                    // Check primary coordinate and nearby offsets (handles slight coordinate inaccuracies)
-                    // Wider search area for better matching
-                    const offsets = [
-                        [0, 0], [5, 0], [-5, 0], [0, 5], [0, -5], 
-                        [5, 5], [-5, -5], [10, 0], [-10, 0], [0, 10], [0, -10],
-                        [10, 5], [-10, 5], [5, 10], [-5, 10]
-                    ];
-                    let bestMatch = null;
+            probe_key = probe_prefix + (x, y) if probe_prefix else None
+            element_info = probe_cache.get(probe_key) if probe_key else None
+            if element_info is None:
+                element_info = page.evaluate("""
+                    ([x, y]) => {
+                        if (typeof x !== 'number' || typeof y !== 'number') {
+                            throw new Error(`invalid coordinates (${x}, ${y})`);
+                        }
+                        // Check primary coordinate and nearby offsets (handles slight coordinate inaccuracies)
+                        // Wider search area for better matching
+                        const offsets = [
+                            [0, 0], [5, 0], [-5, 0], [0, 5], [0, -5], 
+                            [5, 5], [-5, -5], [10, 0], [-10, 0], [0, 10], [0, -10],
+                            [10, 5], [-10, 5], [5, 10], [-5, 10]
+                        ];
+                        let bestMatch = null;
                     
-                    for (const [dx, dy] of offsets) {{
-                        const el = document.elementFromPoint({x} + dx, {y} + dy);
-                        if (!el) continue;
+                        for (const [dx, dy] of offsets) {
+                            const el = document.elementFromPoint(x + dx, y + dy);
+                            if (!el) continue;
                         
-                        const tagName = el.tagName.toLowerCase();
-                        const isInput = tagName === 'input' && 
-                            (el.type === 'text' || el.type === 'search' || el.type === '' || !el.type || el.type === 'tel' || el.type === 'url');
-                        const isTextarea = tagName === 'textarea';
-                        const hasContentEditable = el.contentEditable === 'true';
+                            const tagName = el.tagName.toLowerCase();
+                            const isInput = tagName === 'input' && 
+                                (el.type === 'text' || el.type === 'search' || el.type === '' || !el.type || el.type === 'tel' || el.type === 'url');
+                            const isTextarea = tagName === 'textarea';
+                            const hasContentEditable = el.contentEditable === 'true';
                         
-                        if (isInput || isTextarea || hasContentEditable) {{
-                            bestMatch = {{
-                                isInput: true,
-                                tagName: tagName,
-                                type: el.type || null,
-                                id: el.id || null,
-                                name: el.name || null,
-                                placeholder: el.placeholder || null,
-                                offsetX: dx,
-                                offsetY: dy
-                            }};
-                            break;
-                        }}
-                    }}
+                            if (isInput || isTextarea || hasContentEditable) {
+                                bestMatch = {
+                                    isInput: true,
+                                    tagName: tagName,
+                                    type: el.type || null,
+                                    id: el.id || null,
+                                    name: el.name || null,
+                                    placeholder: el.placeholder || null,
+                                    offsetX: dx,
+                                    offsetY: dy
+                                };
+                                break;
+                            }
+                        }
                     
-                    // If no input found at primary or nearby coordinates, return what's at primary coordinate
-                    if (!bestMatch) {{
-                        const el = document.elementFromPoint({x}, {y});
-                        return {{
-                            isInput: false,
-                            tagName: el ? el.tagName.toLowerCase() : null,
-                            type: el ? (el.type || null) : null
-                        }};
-                    }}
+                        // If no input found at primary or nearby coordinates, return what's at primary coordinate
+                        if (!bestMatch) {
+                            const el = document.elementFromPoint(x, y);
+                            return {
+                                isInput: false,
+                                tagName: el ? el.tagName.toLowerCase() : null,
+                                type: el ? (el.type || null) : null
+                            };
+                        }
                     
-                    return bestMatch;
-                }}
-            """)
+                        return bestMatch;
+                    }
+                """, [x, y])
+                if probe_key and element_info.get("isInput"):
+                    probe_cache[probe_key] = element_info
             
             if element_info.get("isInput"):
                 group["_dom_validated"] = True
@@ -1983,43 +3338,7 @@ def validate_input_fields_against_dom(page, vision_result):
     return vision_result
 
 
-def language_agent(client, context, vision_info, reasoning_instruction=None):
-    next_milestone = context.get("next_milestone", "Unknown")
-    current_url = context.get("current_url", "unknown")
-    carrier = context.get("carrier", "unknown")
-    
-    is_carrier_site = current_url and "seacargotracking" not in current_url and "google.com" not in current_url
-    site_type = "CARRIER SITE" if is_carrier_site else "AGGREGATOR/OTHER"
-    
-    carrier_link_text = None
-    if vision_info and not is_carrier_site:
-        for vision_result in vision_info:
-            if isinstance(vision_result, dict):
-                elements = vision_result.get("elements", [])
-                for element in elements:
-                    label = element.get("label", "")
-                    label_lower = label.lower()
-                    carrier_lower = carrier.lower()
-                    if carrier_lower in label_lower:
-                        if "merchant" in label_lower or "marine" in label_lower or carrier.upper() in label:
-                            carrier_link_text = label
-                            break
-                        elif len(label) > 3 and carrier_lower in label_lower:
-                            carrier_link_text = label
-                            break
-                if carrier_link_text:
-                    break
-    
-    system_prompt = f"""You translate the reasoning agent's instructions into actionable code instructions.
-
-    CURRENT CONTEXT:
-    - Milestone Goal: {next_milestone}
-    - Current URL: {current_url}
-    - Site Type: {site_type}
-    - Target Carrier: {carrier.upper()}
-
-    REASONING AGENT'S INSTRUCTION:
-    {reasoning_instruction if reasoning_instruction else "Not provided"}
+LANGUAGE_AGENT_SYSTEM_PROMPT = """You translate the reasoning agent's instructions into actionable code instructions.
 
     YOUR JOB:
     The reasoning agent tells you what action to take. Your job is to:
@@ -2043,11 +3362,11 @@ def language_agent(client, context, vision_info, reasoning_instruction=None):
     - **CRITICAL**: On aggregator sites (seacargotracking.net), when vision finds a carrier link with visible text:
       * Check vision_info for elements with labels containing the carrier name
       * Extract the EXACT text label from vision results (the label field from the element)
-      * ALWAYS: 1) Close popups/overlays first (try Escape key), 2) Use locator with scroll_into_view_if_needed() to ensure element is visible, 3) Wait 500ms, 4) Click with expect_page()
+      * ALWAYS: 1) Close popups/overlays first (try Escape key), 2) Use locator with scroll_into_view_if_needed() to ensure element is visible, 3) Wait for network idle (networkidle, max 1.5s), 4) Click with expect_page()
       * This prevents clicking on ad overlays that might cover the link
-      * Use: Try Escape key, then page.locator('text=EXACT_TEXT').scroll_into_view_if_needed(), wait 500ms, then click with expect_page()
+      * Use: Try Escape key, then page.locator('text=EXACT_TEXT').scroll_into_view_if_needed(), wait for networkidle (timeout 1500ms), then click with expect_page()
       * Replace EXACT_TEXT with the actual text label found in vision results
-      * Example instruction: "Close any popups (try Escape key), then use page.locator('text=EXACT_CARRIER_LINK_TEXT').scroll_into_view_if_needed(), wait 500ms, then click with expect_page() to handle new tab"
+      * Example instruction: "Close any popups (try Escape key), then use page.locator('text=EXACT_CARRIER_LINK_TEXT').scroll_into_view_if_needed(), wait for networkidle (timeout 1500ms), then click with expect_page() to handle new tab"
       * This is MORE RELIABLE than coordinates because text is deterministic and scrolling ensures visibility
       * Text selectors work even if page layout changes slightly
       * Only fall back to coordinates if text selector fails after retries
@@ -2057,7 +3376,7 @@ def language_agent(client, context, vision_info, reasoning_instruction=None):
     - On carrier sites (URLs NOT containing 'seacargotracking'): ALWAYS use coordinate clicking when vision provides coordinates
     - On aggregator sites: Use text selectors first (when text is available), then coordinates as fallback
     - If reasoning agent provides coordinates (x, y) → instruct: "Use vision_helpers.click_at_coordinates(x, y)"
-    - Vision coordinates with pyautogui are MORE RELIABLE than selectors on carrier sites
+    - Vision coordinates are MORE RELIABLE than selectors on carrier sites
     - Avoids issues with overlays, modals, strict mode violations, and complex DOMs
 
     HANDLING INPUT FIELDS WITH SUBMISSION METHODS:
@@ -2083,14 +3402,10 @@ def language_agent(client, context, vision_info, reasoning_instruction=None):
     RESTRICTIONS:
     - NEVER EVER instruct to hardcode/guess carrier URLs
     - NEVER instruct page.goto() with carrier domains - only allow for known aggregator sites
-    - To reach carrier site: MUST instruct to find and CLICK the {carrier} carrier link, never navigate directly
+    - To reach carrier site: MUST instruct to find and CLICK the target carrier's link, never navigate directly
     - If navigation needed and no link visible → instruct to navigate to known aggregator site (e.g., seacargotracking.net)
     - Request SYNCHRONOUS Playwright code only
 
-    REMINDER FOR THIS STEP:
-    - Focus ONLY on: "{next_milestone}"
-    - On {site_type}: {"PRIORITIZE coordinate clicking" if is_carrier_site else "Use selectors first, coordinates as fallback"}
-
     HANDLING "Data extracted" MILESTONE:
     - When milestone is "Data extracted":
       * Set needs_code=false (no code execution - we read from screenshots)
@@ -2101,14 +3416,14 @@ def language_agent(client, context, vision_info, reasoning_instruction=None):
       * Only high confidence results are returned - if information is not clearly visible in a screenshot, it will check subsequent folds
       * Voyage number must be complete (not cut off), arrival date must be from final destination port, date format must be yyyy-mm-dd
 
-    OUTPUT:
-    {{
+    OUTPUT (a single JSON object):
+    {
     "needs_code": boolean,
     "needs_vision": boolean,
     "instruction": "specific action for playwright manager",
     "expected_outcome": "what should happen",
     "data_to_extract": ["fields if extraction step"]
-    }}
+    }
 
     When to set needs_vision=true:
     - If you need to find elements on the page (carrier links, input fields, buttons, etc.)
@@ -2116,36 +3431,85 @@ def language_agent(client, context, vision_info, reasoning_instruction=None):
     - If you need to analyze what's visible before generating code
     - **ALWAYS set needs_vision=true for "Data extracted" milestone** (to read data from screenshots)
     - Set needs_vision=false if you already have enough information (e.g., navigation to known URL)"""
+
+
+def serialize_vision_info(vision_info):
+    """Compact JSON for a step's vision results."""
+    # Not memoized: the results are mutated in place (DOM validation, scroll adjustment),
+    # so only a full serialization can tell whether a cached digest is still current
+    return json.dumps(vision_info, separators=(",", ":"))
+
+
+def language_agent(client, context, vision_info, reasoning_instruction=None):
+    next_milestone = context.get("next_milestone", "Unknown")
+    current_url = context.get("current_url", "unknown")
+    carrier = context.get("carrier", "unknown")
+    
+    is_carrier_site = current_url and "seacargotracking" not in current_url and "google.com" not in current_url
+    site_type = "CARRIER SITE" if is_carrier_site else "AGGREGATOR/OTHER"
+    
+    carrier_link_text = None
+    if vision_info and not is_carrier_site:
+        for vision_result in vision_info:
+            if isinstance(vision_result, dict):
+                elements = vision_result.get("elements", [])
+                for element in elements:
+                    label = element.get("label", "")
+                    label_lower = label.lower()
+                    carrier_lower = carrier.lower()
+                    if carrier_lower in label_lower:
+                        if "merchant" in label_lower or "marine" in label_lower or carrier.upper() in label:
+                            carrier_link_text = label
+                            break
+                        elif len(label) > 3 and carrier_lower in label_lower:
+                            carrier_link_text = label
+                            break
+                if carrier_link_text:
+                    break
     
-    vision_summary_str = json.dumps(vision_info, indent=2)
+    vision_summary_str = serialize_vision_info(vision_info)
+    carrier_link_hint = ""
     if carrier_link_text and not is_carrier_site:
         vision_summary_str += f"\n\nEXTRACTED CARRIER LINK TEXT FROM VISION: '{carrier_link_text}'"
         vision_summary_str += f"\nINSTRUCTION: Use this exact text in a Playwright text selector. Generate instruction like: 'Use page.click(\\'text={carrier_link_text}\\')' or 'Use page.locator(\\'text={carrier_link_text}\\').click()'"
-    
-    prompt = f"""Context:
-            {json.dumps(context, indent=2)}
+        carrier_link_hint = "IMPORTANT: Vision found carrier link with text: '" + carrier_link_text + "'. Generate instruction that: 1) Closes popups first (try Escape key), 2) Uses this exact text in a Playwright locator with scroll_into_view_if_needed() (e.g., 'Close popups (try Escape), then use page.locator(\\'text=" + carrier_link_text + "\\').scroll_into_view_if_needed(), wait for networkidle (timeout 1500ms), then click with expect_page()') instead of coordinates on aggregator sites. This ensures the link is visible and not covered by ads."
+
+    # Per-step details go in the user message so the system prompt stays a
+    # byte-identical prefix across calls and OpenAI prompt caching applies.
+    prompt = f"""CURRENT CONTEXT:
+            - Milestone Goal: {next_milestone}
+            - Current URL: {current_url}
+            - Site Type: {site_type}
+            - Target Carrier: {carrier.upper()}
+
+            REASONING AGENT'S INSTRUCTION:
+            {reasoning_instruction if reasoning_instruction else "Not provided"}
+
+            REMINDER FOR THIS STEP:
+            - Focus ONLY on: "{next_milestone}"
+            - On {site_type}: {"PRIORITIZE coordinate clicking" if is_carrier_site else "Use selectors first, coordinates as fallback"}
+
+            Context:
+            {serialize_context(context)}
 
             Vision Analysis:
             {vision_summary_str}
 
             Based on the reasoning agent's instruction above, decide if code is needed and provide instruction for playwright manager.
-            {"IMPORTANT: Vision found carrier link with text: '" + carrier_link_text + "'. Generate instruction that: 1) Closes popups first (try Escape key), 2) Uses this exact text in a Playwright locator with scroll_into_view_if_needed() (e.g., 'Close popups (try Escape), then use page.locator(\\'text=" + carrier_link_text + "\\').scroll_into_view_if_needed(), wait 500ms, then click with expect_page()') instead of coordinates on aggregator sites. This ensures the link is visible and not covered by ads." if carrier_link_text and not is_carrier_site else ""}"""
+            {carrier_link_hint}"""
 
     response = client.chat.completions.create(
         model="gpt-4.1-mini",
         messages=[
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": SHARED_KNOWLEDGE_PROMPT},
+            {"role": "system", "content": LANGUAGE_AGENT_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
-        ]
+        ],
+        response_format={"type": "json_object"}
     )
     
     result = response.choices[0].message.content.strip()
     
-    start = result.find("{")
-    end = result.rfind("}") + 1
-    if start != -1 and end > start:
-        result = result[start:end]
-    
     return json.loads(result)
 
 
@@ -2254,16 +3618,12 @@ Return JSON with voyage_number, arrival_date, and confidence."""
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": vision_data_text}
                 ],
-                temperature=0
+                temperature=0,
+                response_format={"type": "json_object"}
             )
             
             result = response.choices[0].message.content.strip()
             
-            start = result.find("{")
-            end = result.rfind("}") + 1
-            if start != -1 and end > start:
-                result = result[start:end]
-            
             extracted = json.loads(result)
             
             confidence = extracted.get("confidence", "low").lower()
@@ -2357,24 +3717,38 @@ def normalize_date_format(date_str):
         return date_str
 
 
-def detect_repeated_failures(history, threshold=2):
-    if len(history) < 2:
-        return None
-    
-    recent_errors = []
-    for entry in history[-3:]:
-        if entry.get("errors") and len(entry["errors"]) > 0:
-            recent_errors.append(entry)
+def detect_repeated_failures(context, threshold=2):
+    # Only failures on the milestone we are still working on are relevant
+    current_milestone = context.remaining_milestones[0] if context.remaining_milestones else None
+    repeated_key, repeated_count = max(
+        ((key, count) for key, count in context.failure_counts.items() if key[0] == current_milestone),
+        key=lambda item: item[1],
+        default=(None, 0)
+    )
     
-    if len(recent_errors) >= threshold:
-        return {
+    error_count = sum(context.recent_error_flags)
+    if len(context.recent_error_flags) >= 2 and error_count >= threshold:
+        detection = {
             "detected": True,
-            "count": len(recent_errors),
+            "count": error_count,
             "pattern": "Multiple consecutive failures detected",
             "recommendation": "Switch to alternative approach immediately"
         }
+    elif repeated_count > threshold:
+        # Not back-to-back, but the same milestone keeps failing the same way
+        detection = {
+            "detected": True,
+            "count": repeated_count,
+            "pattern": "Same failure recurring on one milestone",
+            "recommendation": "The current approach for this milestone keeps failing - try a different element or strategy"
+        }
+    else:
+        return None
     
-    return None
+    if repeated_count >= 2:
+        detection["milestone"], detection["failing_operation"] = repeated_key
+        detection["occurrences"] = repeated_count
+    return detection
 
 
 def validate_combined_milestone_with_vision(client, booking_id, screenshot_paths):
@@ -2423,6 +3797,11 @@ def validate_combined_milestone_with_vision(client, booking_id, screenshot_paths
     for screenshot_info in screenshot_paths:
         screenshot_path = screenshot_info.get("path") if isinstance(screenshot_info, dict) else screenshot_info
         
+        if screenshot_path:
+            try:
+                wait_for_screenshot(screenshot_path)
+            except Exception as e:
+                print(f"⚠️  Screenshot write failed for {screenshot_path}: {e}")
         if not screenshot_path or not Path(screenshot_path).exists():
             continue
         
@@ -2451,6 +3830,61 @@ def validate_combined_milestone_with_vision(client, booking_id, screenshot_paths
     return has_booking_id_found, has_tracking_results_found, combined_notes
 
 
+def _reached_hub_site(context, current_url):
+    current_domain = urlparse(current_url or "").netloc.lower()
+    if "seacargotracking" in current_domain:
+        return True, f"Reached hub site - URL is on aggregator domain: {current_url}"
+    return None
+
+def _reached_carrier_website(context, current_url):
+    current_domain = urlparse(current_url or "").netloc.lower()
+    site_name = (context.carrier or "").lower()
+    if site_name and site_name in current_domain and "seacargotracking" not in current_domain:
+        return True, f"Reached {site_name.upper()} website - URL is on carrier domain: {current_url}"
+    return None
+
+def _failed_step_verdict(context, current_url):
+    """
+    Failures that are clear without the LLM, for any milestone: an error page, or a script
+    that failed outright (not a timeout, which can still leave the page where we wanted it)
+    and left the URL and tab as they were.
+    """
+    if not current_url or current_url.startswith(("chrome-error://", "about:blank")):
+        return False, f"Fatal page state - URL is {current_url or 'unknown'}"
+    response = context.last_response_data or {}
+    error = response.get("error")
+    if response.get("success") is False and error and "timeout" not in str(error).lower() and response.get("error_type") != "TimeoutError":
+        url_before = response.get("url_before")
+        if url_before and url_before == current_url and not response.get("switched_to_new_page"):
+            return False, f"Script failed and the page did not change: {error}"
+    return None
+
+# Deterministic checks keyed by milestone template. A predicate returns (success, reasoning)
+# when the URL alone settles the milestone, or None to fall back to the LLM.
+MILESTONE_PREDICATES = {
+    "Reached hub site": _reached_hub_site,
+    "Reached {carrier} website": _reached_carrier_website,
+}
+
+def milestone_template_for(context, milestone_goal):
+    """Map a formatted milestone back to its DOMAIN_KNOWLEDGE template"""
+    index = context.milestone_index.get(milestone_goal)
+    if index is None:
+        return milestone_goal
+    return DOMAIN_KNOWLEDGE["shipping_tracking_workflow"]["milestones"][index]
+
+
+SUCCESS_FIELD_PATTERN = re.compile(r'"success"\s*:\s*(true|false)')
+
+# Set FAST_STEP_VERDICT=0 to always use the full JSON success evaluation
+FAST_STEP_VERDICT = os.environ.get("FAST_STEP_VERDICT", "1") != "0"
+
+# Set SPECULATIVE_CACHE_REPLAY=1 to run the next milestone's cached script while the current
+# cached milestone is still being validated. Off by default: not every script is safe to
+# rewind with a navigation back to the previous URL.
+SPECULATIVE_CACHE_REPLAY = os.environ.get("SPECULATIVE_CACHE_REPLAY", "0") == "1"
+
+
 def determine_step_success(client, milestone_goal, language_result, context, current_url, post_execution_vision_results, post_execution_screenshots=None):
     if "Accessed services section (if needed)" in milestone_goal:
         execution_success = context.last_response_data.get("success", False) if context.last_response_data else False
@@ -2583,7 +4017,19 @@ def determine_step_success(client, milestone_goal, language_result, context, cur
         if any(action in milestone_goal.lower() for action in ["enter", "type", "submit", "click", "navigate"]):
             return False, f"Milestone '{milestone_goal}' requires code execution but needs_code was false"
         return True, "No code execution needed"
+
+    # URL predicates go first: a script can throw after it already reached the right domain,
+    # and partial script success still counts
+    milestone_template = milestone_template_for(context, milestone_goal)
+    predicate = MILESTONE_PREDICATES.get(milestone_template)
+    verdict = predicate(context, current_url) if predicate else None
+    if verdict is not None:
+        return verdict
     
+    verdict = _failed_step_verdict(context, current_url)
+    if verdict is not None:
+        return verdict
+
     decision_context = {
         "milestone_goal": milestone_goal,
         "current_url": current_url,
@@ -2667,23 +4113,63 @@ def determine_step_success(client, milestone_goal, language_result, context, cur
     - Wrong site: If vision clearly says we're on a different site than milestone requires → FAILURE
     - General confusion: If vision does not show specific tracking results (voyage, vessel, arrival date), this is NOT "Results displayed" - FAILURE
 
-    Now answer: Did we achieve the milestone "{milestone_goal}"?
+    Now answer: Did we achieve the milestone "{milestone_goal}"?"""
+
+    if FAST_STEP_VERDICT:
+        # Single-token Y/N classification: one output token instead of a JSON object.
+        # Either answer is final; the reasoning only feeds the step logs, so failing steps
+        # don't wait on a second call for it (FAST_STEP_VERDICT=0 keeps the JSON reasoning).
+        try:
+            response = client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": prompt + "\n\n    Answer with a single token: Y or N."}],
+                max_tokens=1,
+                logprobs=True,
+                top_logprobs=2
+            )
+            choice = response.choices[0]
+            top_tokens = choice.logprobs.content[0].top_logprobs if choice.logprobs and choice.logprobs.content else []
+            verdict_token = max(top_tokens, key=lambda t: t.logprob).token if top_tokens else (choice.message.content or "")
+            verdict_token = verdict_token.strip().upper()
+            if verdict_token.startswith("Y"):
+                print("🤖 ✅ Milestone verdict: Y")
+                return True, "LLM single-token verdict: Y"
+            if verdict_token.startswith("N"):
+                print("🤖 ❌ Milestone verdict: N")
+                return False, "LLM single-token verdict: N (set FAST_STEP_VERDICT=0 for reasoning)"
+            print(f"⚠️ Unexpected single-token verdict {verdict_token or '?'}, using JSON evaluation")
+        except Exception as e:
+            print(f"⚠️ Single-token verdict failed, using JSON evaluation: {e}")
+
+    prompt += """
 
-    Respond with ONLY JSON: {{"success": true/false, "reasoning": "brief explanation of your common sense conclusion"}}"""
+    Respond with ONLY JSON: {"success": true/false, "reasoning": "brief explanation of your common sense conclusion"}"""
 
     try:
-        response = client.chat.completions.create(
+        # Stream the answer: "success" is the first key, so a positive verdict can be
+        # acted on without waiting for the reasoning tokens. Negative verdicts are read
+        # to the end so the reasoning is available for the retry logs.
+        stream = client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
-            temperature=0
+            temperature=0,
+            response_format={"type": "json_object"},
+            stream=True
         )
         
-        result = response.choices[0].message.content.strip()
-        start = result.find("{")
-        end = result.rfind("}") + 1
-        if start != -1 and end > start:
-            result = result[start:end]
+        result = ""
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            result += chunk.choices[0].delta.content or ""
+            verdict = SUCCESS_FIELD_PATTERN.search(result)
+            if verdict and verdict.group(1) == "true":
+                stream.close()
+                reasoning = "LLM confirmed milestone (streamed verdict, reasoning skipped)"
+                print(f"🤖 ✅ {reasoning}")
+                return True, reasoning
         
+        result = result.strip()
         decision = json.loads(result)
         success = decision.get("success", False)
         reasoning = decision.get('reasoning', 'No reason provided')
@@ -2695,8 +4181,10 @@ def determine_step_success(client, milestone_goal, language_result, context, cur
         fallback_success = not any(err in (current_url or "") for err in ["chrome-error://", "about:blank"])
         return fallback_success, f"LLM evaluation failed: {e}"
 
-def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=False):
-    client = OpenAI()
+def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=False, on_progress=None):
+    client = get_openai_client()
+    # Handshake with the API while we wait for the browser
+    llm_pool.submit(warm_openai_connection, client)
     log_dir = Path("logs") / booking_id
     run_id = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
     
@@ -2704,23 +4192,40 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
     
     if log_dir.exists():
         try:
-            shutil.rmtree(log_dir)
+            # Rename is a single metadata op; the actual delete runs off the request path
+            stale_log_dir = log_dir.with_name(f"{log_dir.name}.old-{run_id}")
+            log_dir.rename(stale_log_dir)
+            threading.Thread(target=shutil.rmtree, args=(stale_log_dir,), kwargs={"ignore_errors": True}, daemon=True).start()
             print(f"🧹 Cleaned up existing logs for {booking_id}")
         except Exception as cleanup_error:
             print(f"⚠️  Could not fully clean up logs (files may be in use): {cleanup_error}")
     
-    logger = Logger(log_dir, run_id)
-    print(f"🔖 Run ID: {run_id}")
     context = CurrentContext()
     context.set_goal(booking_id, carrier)
     print(f"📦 Tracking booking {booking_id} for carrier: {carrier}")
     
-    print("⏳ Waiting for browser to be ready...")
-    time.sleep(10)
-    
-    playwright = sync_playwright().start()
+    logger = None
+    playwright = None
+    vision_helpers = None
+    browser_run_lock.acquire()
     try:
-        browser = playwright.chromium.connect_over_cdp("http://localhost:9222")
+        # Started inside the try so a failed start still closes the logger's writer thread
+        logger = Logger(log_dir, run_id)
+        print(f"🔖 Run ID: {run_id}")
+        playwright = sync_playwright().start()
+        
+        # Poll the CDP endpoint instead of sleeping a fixed 10s: connect as soon as the
+        # browser accepts connections, give up after the same 10s budget
+        print("⏳ Waiting for browser to be ready...")
+        browser = None
+        connect_deadline = time.time() + 10
+        while browser is None:
+            try:
+                browser = playwright.chromium.connect_over_cdp("http://localhost:9222")
+            except Exception:
+                if time.time() >= connect_deadline:
+                    raise
+                time.sleep(0.5)
         print("✅ Connected to existing browser session")
         
         contexts = browser.contexts
@@ -2729,6 +4234,18 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
         if contexts and contexts[0].pages:
             page = contexts[0].pages[0]
             print(f"📄 Using existing page: {page.url}")
+            
+            # Reuse one tab across bookings: drop tabs left over from the previous run and
+            # reset the kept page instead of tearing down and creating renderers per run
+            for stale_page in contexts[0].pages[1:]:
+                try:
+                    stale_page.close()
+                except Exception as close_error:
+                    print(f"⚠️  Could not close leftover tab: {close_error}")
+            try:
+                page.goto("about:blank")
+            except Exception as reset_error:
+                print(f"⚠️  Could not reset existing page: {reset_error}")
         else:
             try:
                 if contexts:
@@ -2753,14 +4270,96 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                     raise Exception(f"Could not create or find a page: {page_create_error}")
 
         vision_helpers = VisionHelpers(page)
+        vision_helpers.install_page_observers()
         playwright_mgr = PlaywrightManager(client, page)
         
         context.update_url(page.url)
         context.update_milestone("Starting automation")
         
+        screenshot_dir = log_dir / "screenshots"
+        screenshot_dir.mkdir(parents=True, exist_ok=True)
+        
+        def capture_step_screenshots(prefix):
+            try:
+                captured = vision_helpers.take_multifold_screenshots(prefix, screenshot_dir)
+                logger.log_operation("screenshot_multifold", {"count": len(captured), "paths": [s["path"] for s in captured]})
+                return captured
+            except Exception as e:
+                logger.log_operation("screenshot_error", {"error": str(e), "error_type": type(e).__name__}, success=False)
+                print(f"⚠️  Screenshot failed: {e}")
+                try:
+                    single_screenshot = vision_helpers.take_screenshot(screenshot_dir / f"{prefix}_fallback.{SCREENSHOT_EXT}")
+                    logger.log_operation("screenshot_fallback", {"path": str(single_screenshot)})
+                    return [{"path": str(single_screenshot), "scroll_top": 0}]
+                except Exception as fallback_error:
+                    logger.log_operation("screenshot_fallback_failed", {"error": str(fallback_error)}, success=False)
+                    print(f"⚠️  Screenshot fallback also failed: {fallback_error}")
+                    return []
+        
+        def report_progress(step, pipeline_entry):
+            if not on_progress:
+                return
+            try:
+                on_progress({
+                    "type": "step",
+                    "step": step,
+                    "milestone": pipeline_entry.get("milestone"),
+                    "success": pipeline_entry.get("success"),
+                    "current_url": pipeline_entry.get("current_url"),
+                    "remaining_milestones": list(context.remaining_milestones)
+                })
+            except Exception as progress_error:
+                print(f"⚠️  Progress callback failed: {progress_error}")
+        
+        def speculate_next_cached_milestone(milestone):
+            """Execute the cached script of the milestone after `milestone`, if there is one."""
+            index = context.milestone_index.get(milestone)
+            if index is None or index + 1 >= len(context.formatted_milestones):
+                return None
+            following = context.formatted_milestones[index + 1]
+            cached = milestone_cache.get_milestone_cache(carrier, booking_id, following)
+            if not cached or not cached.get("script"):
+                return None
+            
+            speculation = {"milestone": following, "cached": cached, "url_before": page.url, "exec_result": None}
+            logger.log_operation("speculative_execution_start", {"milestone": following, "script": cached["script"]})
+            print(f"🔮 Speculatively executing cached script for '{following}'")
+            try:
+                speculation["exec_result"] = playwright_mgr.execute(cached["script"], vision_helpers, context, following)
+            except Exception as e:
+                logger.log_operation("speculative_execution_error", {"milestone": following, "error": str(e)}, success=False)
+            return speculation
+        
+        def rewind_speculation(speculation):
+            """Undo a speculative replay: drop any tab it opened and navigate back."""
+            if not speculation:
+                return
+            new_page_ref = (speculation["exec_result"] or {}).get("_new_page_ref")
+            try:
+                if new_page_ref and new_page_ref is not page and not new_page_ref.is_closed():
+                    new_page_ref.close()
+                # A click into a new tab rebinds the helpers to it; point them back at the loop's page
+                vision_helpers.page = page
+                playwright_mgr.set_page(page)
+                page.goto(speculation["url_before"], wait_until="domcontentloaded", timeout=15000)
+                logger.log_operation("speculative_execution_rewound", {"milestone": speculation["milestone"], "url": speculation["url_before"]})
+            except Exception as e:
+                logger.log_operation("speculative_rewind_error", {"milestone": speculation["milestone"], "error": str(e)}, success=False)
+        
+        # Screenshots of the current page taken while the previous step's success check
+        # was in flight; only valid until the next browser action
+        prefetched_screenshots = None
+        # Result of running the next milestone's cached script ahead of time (SPECULATIVE_CACHE_REPLAY)
+        pending_speculation = None
+        
         for step in range(1, max_steps + 1):
             if "voyage_number" in context.extracted_data and "arrival_date" in context.extracted_data:
                 logger.log_operation("goal_achieved", context.extracted_data)
+                milestone_cache.save_final_results(
+                    carrier, booking_id,
+                    context.extracted_data.get("voyage_number"),
+                    context.extracted_data.get("arrival_date")
+                )
                 break
             
             logger.start_step()
@@ -2771,27 +4370,55 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
             next_milestone = context.remaining_milestones[0] if context.remaining_milestones else None
             cached_milestone = None
             cache_hit = False
+            page_signature = None
+            
+            speculation = pending_speculation
+            pending_speculation = None
+            if speculation and (speculation["milestone"] != next_milestone or not speculation["exec_result"]):
+                rewind_speculation(speculation)
+                speculation = None
             
             if next_milestone:
-                if force_fresh:
+                if speculation:
+                    cached_milestone = speculation["cached"]
+                elif force_fresh:
                     cached_milestone = None
                 else:
                     cached_milestone = milestone_cache.get_milestone_cache(carrier, booking_id, next_milestone)
                 
+                if not cached_milestone:
+                    # Exact miss: fingerprint the page so a script cached for another booking on
+                    # a matching page can be replayed, and so a new script is saved with it
+                    page_signature = vision_helpers.get_dom_signature()
+                    if not force_fresh:
+                        cached_milestone = (
+                            milestone_cache.find_similar_milestone(carrier, next_milestone, page_signature, exclude_booking_id=booking_id)
+                            or milestone_cache.get_playbook_entry(carrier, next_milestone)
+                        )
+                
                 if cached_milestone:
                     print(f"🔍 Cache hit for milestone: '{next_milestone}'")
                     logger.log_operation("cache_check", {
                         "milestone": next_milestone,
                         "cache_found": True,
+                        "match": "playbook" if cached_milestone.get("playbook") else "similar" if "similarity" in cached_milestone else "exact",
+                        "similarity": cached_milestone.get("similarity"),
                         "cached_at": cached_milestone.get("cached_at")
                     })
+                    # The signature describes the page before replay; after it the page has moved on
+                    replay_signature = page_signature
+                    page_signature = None
                     
+                    prefetched_screenshots = None
                     try:
                         cached_script = cached_milestone.get("script")
                         logger.log_operation("cache_execution_start", {"script": cached_script})
-                        print(f"⚡ Executing cached script for '{next_milestone}'")
-                        
-                        exec_result = playwright_mgr.execute(cached_script, vision_helpers, context, next_milestone)
+                        if speculation:
+                            print(f"⚡ Using speculative execution of cached script for '{next_milestone}'")
+                            exec_result = speculation["exec_result"]
+                        else:
+                            print(f"⚡ Executing cached script for '{next_milestone}'")
+                            exec_result = playwright_mgr.execute(cached_script, vision_helpers, context, next_milestone)
                         
                         new_page_ref = exec_result.pop("_new_page_ref", None) if exec_result.get("success") else None
                         
@@ -2801,7 +4428,7 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                         if exec_result.get("switched_to_new_page") and new_page_ref:
                             try:
                                 new_page = new_page_ref
-                                old_url = page.url if not page.is_closed() else "unknown"
+                                old_url = page_url_or(page)
                                 old_page = page
                                 
                                 page = new_page
@@ -2815,7 +4442,7 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                                 except Exception as close_error:
                                     print(f"⚠️  Could not close old tab: {close_error}")
                                 
-                                new_url = new_page.url if not new_page.is_closed() else "unknown"
+                                new_url = page_url_or(new_page)
                                 context.update_url(new_url)
                                 logger.log_operation("tab_switched_from_cache", {
                                     "old_url": old_url, 
@@ -2840,8 +4467,11 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                                 print(f"⚠️  Error switching to new tab (from cache): {e}")
                         
                         try:
-                            time.sleep(0.5)
-                            current_url = page.url if not page.is_closed() else context.current_url or "unknown"
+                            try:
+                                page.wait_for_load_state("domcontentloaded", timeout=2000)
+                            except Exception:
+                                pass
+                            current_url = page_url_or(page, context.current_url or "unknown")
                             context.update_url(current_url)
                             logger.log_operation("url_updated_after_cache", {"url": current_url})
                         except Exception as e:
@@ -2856,7 +4486,8 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                             if "Data extracted" in next_milestone:
                                 language_result_for_validation["needs_code"] = False
                             
-                            step_succeeded, step_reasoning = determine_step_success(
+                            validation_future = llm_pool.submit(
+                                determine_step_success,
                                 client=client,
                                 milestone_goal=next_milestone,
                                 language_result=language_result_for_validation,
@@ -2864,9 +4495,16 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                                 current_url=context.current_url,
                                 post_execution_vision_results={}  # Cache execution, no vision yet
                             )
+                            # The validation only reads state captured above, so the browser is
+                            # free to run ahead into the next cached milestone meanwhile
+                            speculation = None
+                            if SPECULATIVE_CACHE_REPLAY and not force_fresh:
+                                speculation = speculate_next_cached_milestone(next_milestone)
+                            step_succeeded, step_reasoning = validation_future.result()
                             
                             if step_succeeded:
                                 # Cache validation passed - mark milestone complete and skip LLM reasoning
+                                pending_speculation = speculation
                                 cache_hit = True
                                 used_cache = True
                                 context.update_milestone(next_milestone)
@@ -2877,6 +4515,16 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                                 })
                                 print(f"✅ Cache validation passed: Milestone '{next_milestone}' completed")
                                 
+                                if "similarity" in cached_milestone or cached_milestone.get("playbook"):
+                                    milestone_cache.save_milestone(
+                                        carrier=carrier,
+                                        booking_id=booking_id,
+                                        milestone=next_milestone,
+                                        script=cached_script,
+                                        operations=logger.step_operations,
+                                        dom_signature=replay_signature
+                                    )
+                                
                                 # End this step and continue to next iteration
                                 pipeline_entry = logger.end_step(
                                     milestone=next_milestone,
@@ -2884,9 +4532,11 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                                     success=True
                                 )
                                 context.add_to_history(pipeline_entry)
+                                report_progress(step, pipeline_entry)
                                 continue  # Skip to next step
                             else:
                                 # Cache validation failed - fall back to LLM reasoning
+                                rewind_speculation(speculation)
                                 print(f"⚠️  Cache validation failed for '{next_milestone}': {step_reasoning}")
                                 logger.log_operation("cache_validation_failed", {
                                     "milestone": next_milestone,
@@ -2904,17 +4554,22 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                     })
             
             if not cache_hit:
-                failure_detection = detect_repeated_failures(context.history)
+                failure_detection = detect_repeated_failures(context)
                 if failure_detection:
                     logger.log_operation("failure_pattern_detected", failure_detection, success=False)
                     print(f"⚠️  Repeated failures detected: {failure_detection['pattern']}")
                 
                 context_dict = context.to_dict()
                 if failure_detection:
-                    context_dict["failure_alert"] = failure_detection
+                    context_dict = {**context_dict, "failure_alert": failure_detection}
                 
                 logger.log_operation("reasoning_query", {"context": context_dict})
-                reasoning_result = reasoning_agent(client, context_dict)
+                reasoning_future = llm_pool.submit(reasoning_agent, client, context_dict)
+                # Capture this step's screenshots while the reasoning call is in flight;
+                # the reasoning agent works from the context only, never the browser
+                if not prefetched_screenshots:
+                    prefetched_screenshots = capture_step_screenshots(f"step_{step}")
+                reasoning_result = reasoning_future.result()
                 logger.log_operation("reasoning_response", reasoning_result)
                 
                 ad_recovery = reasoning_result.get("ad_recovery")
@@ -2929,28 +4584,25 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                         "reset_to_milestone": reset_milestone
                     })
                     
+                    prefetched_screenshots = None
                     try:
                         page.goto(recovery_url, timeout=30000, wait_until='load')
-                        time.sleep(1)
                         
                         current_url = page.url
                         context.update_url(current_url)
                         
                         if reset_milestone:
-                            all_milestones = DOMAIN_KNOWLEDGE["shipping_tracking_workflow"]["milestones"]
-                            formatted_milestones = [m.format(carrier=context.carrier.upper()) for m in all_milestones]
-                            
-                            try:
-                                reset_idx = formatted_milestones.index(reset_milestone)
-                                context.remaining_milestones = formatted_milestones[reset_idx:]
-                                context.last_achieved_milestone = formatted_milestones[reset_idx - 1] if reset_idx > 0 else "Starting automation"
+                            reset_idx = context.milestone_index.get(reset_milestone)
+                            if reset_idx is not None:
+                                context.remaining_milestones = list(context.formatted_milestones[reset_idx:])
+                                context.last_achieved_milestone = context.formatted_milestones[reset_idx - 1] if reset_idx > 0 else "Starting automation"
                                 
                                 print(f"♻️  Milestones reset to: {reset_milestone}")
                                 logger.log_operation("milestones_reset", {
                                     "reset_to": reset_milestone,
                                     "remaining": context.remaining_milestones
                                 })
-                            except ValueError:
+                            else:
                                 print(f"⚠️  Could not find milestone '{reset_milestone}' in list, keeping current milestones")
                         
                         logger.log_operation("ad_recovery_success", {
@@ -2965,6 +4617,7 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                             success=True
                         )
                         context.add_to_history(pipeline_entry)
+                        report_progress(step, pipeline_entry)
                         continue  # Skip to next step with recovered state
                         
                     except Exception as recovery_error:
@@ -2985,38 +4638,38 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
             if cache_hit:
                 continue
             
-            screenshot_dir = log_dir / "screenshots"
-            screenshot_dir.mkdir(parents=True, exist_ok=True)
-            
-            screenshots = []
-            try:
-                screenshots = vision_helpers.take_multifold_screenshots(f"step_{step}", screenshot_dir)
-                logger.log_operation("screenshot_multifold", {"count": len(screenshots), "paths": [s["path"] for s in screenshots]})
-            except Exception as e:
-                logger.log_operation("screenshot_error", {"error": str(e), "error_type": type(e).__name__}, success=False)
-                print(f"⚠️  Screenshot failed: {e}")
-                try:
-                    single_screenshot = vision_helpers.take_screenshot(screenshot_dir / f"step_{step}_fallback.png")
-                    screenshots = [{"path": str(single_screenshot), "scroll_top": 0}]
-                    logger.log_operation("screenshot_fallback", {"path": str(single_screenshot)})
-                except Exception as fallback_error:
-                    logger.log_operation("screenshot_fallback_failed", {"error": str(fallback_error)}, success=False)
-                    print(f"⚠️  Screenshot fallback also failed: {fallback_error}")
+            if prefetched_screenshots:
+                screenshots = prefetched_screenshots
+                logger.log_operation("screenshot_prefetched", {"count": len(screenshots), "paths": [s["path"] for s in screenshots]})
+            else:
+                screenshots = capture_step_screenshots(f"step_{step}")
+            prefetched_screenshots = None
             
             context.update_screenshots(screenshots[0]["path"] if screenshots else None, screenshots)
             
             reasoning_instruction = reasoning_result.get("language_instruction", "")
             logger.log_operation("language_query", {"context": context.to_dict(), "reasoning_instruction": reasoning_instruction})
-            language_result = language_agent(client, context.to_dict(), [], reasoning_instruction)
+            language_future = llm_pool.submit(language_agent, client, context.to_dict(), [], reasoning_instruction)
+            # The vision queries only need the reasoning agent's objective and this step's
+            # screenshots, so when it set one they start alongside the language call instead of
+            # after it; if the language agent turns out not to need vision they are dropped
+            vision_objective = reasoning_result.get("vision_objective")
+            vision_futures = submit_vision_queries(client, screenshots, vision_objective) if vision_objective and screenshots else None
+            language_result = language_future.result()
             logger.log_operation("language_response", language_result)
             
             vision_results = []
+            if not language_result.get("needs_vision") and vision_futures:
+                cancel_pending(vision_futures)
             if language_result.get("needs_vision"):
-                vision_objective = reasoning_result.get("vision_objective", "Analyze the page")
+                vision_objective = vision_objective or "Analyze the page"
                 for screenshot in screenshots:
                     logger.log_operation("vision_query", {"screenshot": screenshot["path"], "objective": vision_objective})
+                if vision_futures is None:
+                    vision_futures = submit_vision_queries(client, screenshots, vision_objective)
+                for screenshot, vision_future in zip(screenshots, vision_futures):
                     try:
-                        vision_result = vision_agent(client, screenshot["path"], vision_objective)
+                        vision_result = vision_future.result()
                         
                         scroll_top = screenshot.get("scroll_top", 0)
                         if scroll_top > 0:
@@ -3029,7 +4682,7 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                         
                         if vision_result.get("input_groups") and page:
                             try:
-                                vision_result = validate_input_fields_against_dom(page, vision_result)
+                                vision_result = validate_input_fields_against_dom(page, vision_result, context.input_probes)
                                 if len(vision_result.get("input_groups", [])) == 0 and original_vision_result and len(original_vision_result.get("input_groups", [])) > 0:
                                     vision_result["_original_input_groups"] = original_vision_result.get("input_groups")
                                     vision_result["_dom_validation_filtered_all"] = True
@@ -3051,12 +4704,14 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                             break
                     except Exception as e:
                         logger.log_operation("vision_error", {"error": str(e)}, success=False)
+                cancel_pending(vision_futures)
                 
                 if vision_results:
                     logger.log_operation("language_query_with_vision", {"vision_results": vision_results})
                     language_result = language_agent(client, context.to_dict(), vision_results, reasoning_instruction)
                     logger.log_operation("language_response_with_vision", language_result)
             
+            page_unchanged = False
             if language_result.get("needs_code"):
                 instruction = language_result.get("instruction")
                 context.update_script(None, instruction)
@@ -3069,8 +4724,11 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                 logger.log_operation("script_compilation", compile_result)
                 
                 if compile_result["success"]:
+                    pre_execution_fingerprint = vision_helpers.get_page_fingerprint()
                     logger.log_operation("script_execution_start", {"script": compile_result["code"]})
                     exec_result = playwright_mgr.execute(compile_result["code"], vision_helpers, context, next_milestone)
+                    # The script may have changed the DOM under any cached point
+                    context.input_probes.clear()
                     
                     context.update_script(compile_result["code"], instruction)
                     
@@ -3082,7 +4740,7 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                     if exec_result.get("switched_to_new_page") and new_page_ref:
                         try:
                             new_page = new_page_ref
-                            old_url = page.url if not page.is_closed() else "unknown"
+                            old_url = page_url_or(page)
                             old_page = page
                             
                             page = new_page
@@ -3096,7 +4754,7 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                             except Exception as close_error:
                                 print(f"⚠️  Could not close old tab: {close_error}")
                             
-                            new_url = new_page.url if not new_page.is_closed() else "unknown"
+                            new_url = page_url_or(new_page)
                             context.update_url(new_url)
                             logger.log_operation("tab_switched", {
                                 "old_url": old_url, 
@@ -3123,25 +4781,42 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                             print(f"⚠️  Error switching to new tab: {e}")
                     
                     try:
-                        time.sleep(0.5)
-                        current_url = page.url if not page.is_closed() else context.current_url or "unknown"
+                        try:
+                            page.wait_for_load_state("domcontentloaded", timeout=2000)
+                        except Exception:
+                            pass
+                        current_url = page_url_or(page, context.current_url or "unknown")
                         context.update_url(current_url)
                         logger.log_operation("url_updated_after_script", {"url": current_url})
                     except Exception as e:
                         logger.log_operation("url_update_error_after_script", {"error": str(e)}, success=False)
+                    
+                    # Scripts that only read the DOM (or did nothing) leave the page as it was, so
+                    # post-execution screenshots and vision would just describe the same page again
+                    if pre_execution_fingerprint and not exec_result.get("switched_to_new_page"):
+                        # execute no longer sleeps after the script, and domcontentloaded returns at
+                        # once without a navigation; give XHR-rendered results a capped chance to land
+                        try:
+                            page.wait_for_load_state("networkidle", timeout=POST_EXEC_SETTLE_MS)
+                        except Exception:
+                            pass
+                        page_unchanged = vision_helpers.get_page_fingerprint() == pre_execution_fingerprint
                 else:
                     logger.log_operation("script_compilation_failed", compile_result, success=False)
                     context.update_response(compile_result, "compilation_failed")
             
             post_execution_screenshots = []
-            if language_result.get("needs_code"):
+            if page_unchanged:
+                logger.log_operation("post_vision_skipped_no_change", {"url": context.current_url})
+                print("ℹ️  Page unchanged after script, skipping post-execution screenshots and vision")
+            elif language_result.get("needs_code"):
                 try:
                     post_execution_screenshots = vision_helpers.take_multifold_screenshots(f"step_{step}_post", screenshot_dir)
                     logger.log_operation("screenshot_post_execution", {"count": len(post_execution_screenshots), "paths": [s["path"] for s in post_execution_screenshots]})
                 except Exception as e:
                     logger.log_operation("screenshot_post_execution_error", {"error": str(e)}, success=False)
                     try:
-                        single_screenshot = vision_helpers.take_screenshot(screenshot_dir / f"step_{step}_post_fallback.png")
+                        single_screenshot = vision_helpers.take_screenshot(screenshot_dir / f"step_{step}_post_fallback.{SCREENSHOT_EXT}")
                         post_execution_screenshots = [{"path": str(single_screenshot), "scroll_top": 0}]
                     except:
                         pass
@@ -3157,8 +4832,10 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                 
                 for screenshot in post_execution_screenshots:
                     logger.log_operation("vision_query_post_execution", {"screenshot": screenshot["path"], "objective": post_vision_objective})
+                post_vision_futures = submit_vision_queries(client, post_execution_screenshots, post_vision_objective)
+                for screenshot, vision_future in zip(post_execution_screenshots, post_vision_futures):
                     try:
-                        vision_result = vision_agent(client, screenshot["path"], post_vision_objective)
+                        vision_result = vision_future.result()
                          
                         scroll_top = screenshot.get("scroll_top", 0)
                         if scroll_top > 0:
@@ -3170,12 +4847,13 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                             break
                     except Exception as e:
                         logger.log_operation("vision_error_post_execution", {"error": str(e)}, success=False)
+                cancel_pending(post_vision_futures)
             
             if post_execution_vision_results:
                 context.vision_analysis_after_action = post_execution_vision_results
             
             try:
-                current_url = page.url if not page.is_closed() else context.current_url or "unknown"
+                current_url = page_url_or(page, context.current_url or "unknown")
                 context.update_url(current_url)
             except Exception as e:
                 logger.log_operation("url_update_error", {"error": str(e)}, success=False)
@@ -3198,16 +4876,19 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                     if vision_results_for_extraction:
                         extracted_from_vision = extract_data_from_vision_results(client, vision_results_for_extraction)
                         if extracted_from_vision:
-                            context.extracted_data.update(extracted_from_vision)
+                            context.update_extracted_data(extracted_from_vision)
                             logger.log_operation("data_extracted_from_vision", extracted_from_vision)
                             print(f"📊 Extracted from vision: Voyage={extracted_from_vision.get('voyage_number', '')}, Arrival={extracted_from_vision.get('arrival_date', '')}")
                 
                 if context.last_response_data and isinstance(context.last_response_data, dict):
                     result = context.last_response_data.get("result")
                     if result:
-                        context.extracted_data.update(result)
+                        context.update_extracted_data(result)
             
-            step_succeeded, step_reasoning = determine_step_success(
+            # Run the success check on a worker thread and use the wait to capture the
+            # screenshots the next step will start from (the page does not change in between)
+            success_future = llm_pool.submit(
+                determine_step_success,
                 client=client,
                 milestone_goal=reasoning_result.get("next_milestone"),
                 language_result=language_result,
@@ -3216,6 +4897,9 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                 post_execution_vision_results=post_execution_vision_results,
                 post_execution_screenshots=post_execution_screenshots
             )
+            if step < max_steps and "Data extracted" not in (reasoning_result.get("next_milestone") or ""):
+                prefetched_screenshots = capture_step_screenshots(f"step_{step + 1}")
+            step_succeeded, step_reasoning = success_future.result()
             
             if step_succeeded:
                 completed_milestone = reasoning_result.get("next_milestone")
@@ -3236,7 +4920,8 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                         booking_id=booking_id,
                         milestone=completed_milestone,
                         script=context.last_tried_script,
-                        operations=logger.step_operations
+                        operations=logger.step_operations,
+                        dom_signature=page_signature if completed_milestone == next_milestone else None
                     )
                     print(f"💾 Milestone cached: '{completed_milestone}'")
             else:
@@ -3248,7 +4933,7 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                         
             
             try:
-                step_url = page.url if not page.is_closed() else context.current_url or "unknown"
+                step_url = page_url_or(page, context.current_url or "unknown")
             except Exception:
                 step_url = context.current_url or "unknown"
             
@@ -3258,6 +4943,7 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                 success=step_succeeded
             )
             context.add_to_history(pipeline_entry)
+            report_progress(step, pipeline_entry)
         
         print("🎉 Automation completed!")
         return {
@@ -3284,12 +4970,82 @@ def real_tracking_process(booking_id, carrier="hmm", max_steps=20, force_fresh=F
                 "used_cache": False
             }
     finally:
-        playwright.stop()
+        try:
+            if vision_helpers is not None:
+                # Let queued screenshot writes land before the run's logs are closed
+                vision_helpers.flush()
+            if logger is not None:
+                logger.close()
+            if playwright is not None:
+                playwright.stop()
+        finally:
+            browser_run_lock.release()
+
+def claim_booking(booking_id):
+    """Mark a booking as in flight; returns False if another request is already tracking it"""
+    with requested_bookings_lock:
+        if booking_id in requested_bookings:
+            return False
+        requested_bookings.add(booking_id)
+        return True
+
+def release_booking(booking_id):
+    with requested_bookings_lock:
+        requested_bookings.discard(booking_id)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat()})
 
+def build_track_response(booking_id, result, execution_time):
+    extracted_data = result.get("extracted_data", {})
+    used_cache = result.get("used_cache", False)
+    
+    print(f"⏱️  Execution time: {execution_time:.2f}s, Used cache: {used_cache}")
+    
+    return {
+        "success": True,
+        "booking_id": booking_id,
+        "voyage_number": extracted_data.get("voyage_number"),
+        "arrival_date": extracted_data.get("arrival_date"),
+        "execution_time": round(execution_time, 2),
+        "used_cache": used_cache,
+        "timestamp": datetime.now().isoformat(),
+        "extracted_data": extracted_data
+    }
+
+
+def stream_tracking_events(booking_id, carrier, force_fresh):
+    """
+    Start tracking on a worker thread and return a generator of NDJSON lines as steps
+    complete, ending with the same payload the non-streaming endpoint returns.
+    The worker starts here rather than on the first read, so it releases the booking
+    even if the client disconnects before the response body is consumed.
+    """
+    events = queue.Queue()
+    start_time = time.time()
+    
+    def run():
+        try:
+            result = real_tracking_process(booking_id, carrier, force_fresh=force_fresh, on_progress=events.put)
+            events.put({"type": "result", **build_track_response(booking_id, result, time.time() - start_time)})
+        except Exception as e:
+            events.put({"type": "error", "error": str(e)})
+        finally:
+            release_booking(booking_id)
+    
+    threading.Thread(target=run, daemon=True).start()
+    
+    def lines():
+        while True:
+            event = events.get()
+            yield json.dumps(event) + "\n"
+            if event["type"] in ("result", "error"):
+                break
+    
+    return lines()
+
+
 @app.route('/track', methods=['POST'])
 def track_booking():
     try:
@@ -3301,29 +5057,26 @@ def track_booking():
         if not booking_id:
             return jsonify({"error": "booking_id is required"}), 400
         
-        start_time = time.time()
-        
-        result = real_tracking_process(booking_id, carrier, force_fresh=force_fresh)
-        
-        execution_time = time.time() - start_time
-        
-        extracted_data = result.get("extracted_data", {})
-        used_cache = result.get("used_cache", False)
+        if not claim_booking(booking_id):
+            return jsonify({"error": f"Tracking already in progress for {booking_id}"}), 409
         
-        print(f"⏱️  Execution time: {execution_time:.2f}s, Used cache: {used_cache}")
-        
-        response = {
-            "success": True,
-            "booking_id": booking_id,
-            "voyage_number": extracted_data.get("voyage_number"),
-            "arrival_date": extracted_data.get("arrival_date"),
-            "execution_time": round(execution_time, 2),
-            "used_cache": used_cache,
-            "timestamp": datetime.now().isoformat(),
-            "extracted_data": extracted_data
-        }
+        if data.get('stream', False):
+            # The worker thread releases the booking once the run finishes
+            try:
+                event_lines = stream_tracking_events(booking_id, carrier, force_fresh)
+            except Exception:
+                release_booking(booking_id)
+                raise
+            return Response(event_lines, mimetype="application/x-ndjson")
         
-        return jsonify(response)
+        try:
+            start_time = time.time()
+            
+            result = real_tracking_process(booking_id, carrier, force_fresh=force_fresh)
+            
+            return jsonify(build_track_response(booking_id, result, time.time() - start_time))
+        finally:
+            release_booking(booking_id)
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -79,8 +79,10 @@ echo "📺 Connect via VNC: localhost:5900 (password: secret)"
 echo "🌐 Connect via browser: http://localhost:6080"
 
 # Start the Flask API for evaluation
+# gunicorn with threaded workers so /track streaming and health checks are served concurrently;
+# a single worker keeps the in-process caches shared, --timeout 0 allows long tracking runs
 echo "🚀 Starting Flask API on port 5000 (internal)..."
-python api.py &
+gunicorn --bind 0.0.0.0:5000 --worker-class gthread --workers 1 --threads 4 --timeout 0 api:app &
 FLASK_PID=$!
 
 echo "🔥 Flask API started!"
@@ -0,0 +1,33 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from api import read_tail_lines
+
+
+class ReadTailLinesTest(unittest.TestCase):
+    def write(self, data):
+        handle = tempfile.NamedTemporaryFile(delete=False)
+        handle.write(data)
+        handle.close()
+        self.addCleanup(os.unlink, handle.name)
+        return handle.name
+
+    def test_chunk_boundary_at_line_start_keeps_line(self):
+        path = self.write(b"x\nA\nB\n")
+        self.assertEqual(read_tail_lines(path, 2, chunk_size=5), [b"A", b"B"])
+
+    def test_chunk_boundary_mid_line_drops_partial_line(self):
+        path = self.write(b"first\nA\nB\n")
+        self.assertEqual(read_tail_lines(path, 2, chunk_size=4), [b"A", b"B"])
+
+    def test_whole_file_read(self):
+        path = self.write(b"A\n\nB\nC")
+        self.assertEqual(read_tail_lines(path, 5), [b"A", b"B", b"C"])
+
+
+if __name__ == "__main__":
+    unittest.main()